@@ -0,0 +1,266 @@
+#! /usr/bin/python3
+# coding: utf-8
+"""不需要手机的性能测试：生成测试用的安装包，使用假 adb 安装，记录总耗时和各阶段耗时。
+
+    python bench/bench.py                # 运行并和基准比较，变慢时返回 1
+    python bench/bench.py --save         # 保存为新的基准
+    python bench/bench.py --size 200 --splits 12 --obb 500 --devices 2 --latency 20 --bandwidth 40
+
+各阶段耗时来自 xapkInstaller 的 --trace，基准按参数保存在 bench/baseline.json(和电脑有关，不提交)，
+安装包、假设备的文件等保存在 bench/work。
+"""
+import argparse
+import io
+import logging
+import os
+import random
+import struct
+import sys
+import time
+from json import dump as json_dump
+from json import dumps as json_dumps
+from json import load as json_load
+from pathlib import Path
+from typing import Dict, List
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
+
+bench_dir = Path(__file__).resolve().parent
+sys.path.insert(0, str(bench_dir.parent))
+abi_list = ["arm64_v8a", "armeabi_v7a", "x86", "x86_64"]
+density_list = ["xxhdpi", "xhdpi", "xxxhdpi", "hdpi", "mdpi"]
+language_list = ["zh", "en", "ja", "ko", "fr", "de", "es", "ru", "pt", "it"]
+
+
+# ========================= 生成安装包 =========================
+def axml(package: str, version_code: int, split: str = "") -> bytes:
+    """最小的二进制 AndroidManifest.xml，包含 package，versionCode，minSdkVersion，targetSdkVersion"""
+    strings = ["versionCode", "minSdkVersion", "targetSdkVersion", "android",
+               "http://schemas.android.com/apk/res/android", "manifest", "package", package, "uses-sdk", "split", split]
+    data, offset = b"", []
+    for i in strings:
+        offset.append(len(data))
+        data += struct.pack("<H", len(i)) + i.encode("utf-16le") + b"\0\0"
+    data += b"\0" * (-len(data) % 4)
+    pool = struct.pack("<IIIII", len(strings), 0, 0, 28+4*len(strings), 0) + struct.pack(f"<{len(offset)}I", *offset) + data
+    pool = struct.pack("<HHI", 0x0001, 28, 8+len(pool)) + pool
+    resource = struct.pack("<HHI3I", 0x0180, 8, 20, 0x0101021B, 0x0101020C, 0x01010270)
+
+    def attr(ns: int, name: int, _type: int, value: int) -> bytes:
+        return struct.pack("<IIIHBBI", ns, name, value if _type == 3 else 0xFFFFFFFF, 8, 0, _type, value)
+
+    def node(_type: int, body: bytes) -> bytes:
+        body = struct.pack("<II", 1, 0xFFFFFFFF) + body
+        return struct.pack("<HHI", _type, 16, 8+len(body)) + body
+
+    def start(name: int, attrs: List[bytes]) -> bytes:
+        return node(0x0102, struct.pack("<IIHHHHHH", 0xFFFFFFFF, name, 20, 20, len(attrs), 0, 0, 0) + b"".join(attrs))
+
+    none = 0xFFFFFFFF
+    manifest = [attr(4, 0, 0x10, version_code), attr(none, 6, 3, 7)]
+    if split:
+        manifest.append(attr(none, 9, 3, 10))
+    nodes = node(0x0100, struct.pack("<II", 3, 4)) + start(5, manifest)
+    nodes += start(8, [attr(4, 1, 0x10, 21), attr(4, 2, 0x10, 33)]) + node(0x0103, struct.pack("<II", none, 8))
+    nodes += node(0x0103, struct.pack("<II", none, 5)) + node(0x0101, struct.pack("<II", 3, 4))
+    body = pool + resource + nodes
+    return struct.pack("<HHI", 0x0003, 8, 8+len(body)) + body
+
+
+def make_apk(package: str, size: int, split: str = "", abi: str = "") -> bytes:
+    """随机内容无法压缩，和真实安装包中的 dex、so 类似"""
+    f = io.BytesIO()
+    with ZipFile(f, "w", ZIP_DEFLATED) as zip_file:
+        zip_file.writestr("AndroidManifest.xml", axml(package, 2, split))
+        name = f"lib/{abi.replace('_', '-')}/libbench.so" if abi else "classes.dex"
+        zip_file.writestr(name, random.randbytes(size), ZIP_STORED)
+    return f.getvalue()
+
+
+def split_list(count: int) -> List[str]:
+    """count 个配置分包：abi、屏幕密度、语言轮流"""
+    result, dimensions = [], [abi_list, density_list, language_list]
+    for i in range(count):
+        values = dimensions[i % 3]
+        if i//3 < len(values):
+            result.append(values[i//3])
+    return result
+
+
+def make_packages(out: Path, size: int, splits: int, obb: int) -> Dict[str, Path]:
+    """生成 apk、xapk、apkm、apks 和带 obb 的 xapk，size、obb 为字节数，分包平分 size 的一半"""
+    os.makedirs(out, exist_ok=True)
+    package = "com.bench.app"
+    configs = split_list(splits)
+    split_size = size//2//max(len(configs), 1)
+    base_size = size - split_size*len(configs)
+    base = make_apk(package, base_size)
+    split_apk = {i: make_apk(package, split_size, "config."+i, i if i in abi_list else "") for i in configs}
+    files = {i: out/f"bench.{i}" for i in ["apk", "xapk", "apkm", "apks"]}
+    files["obb"] = out/"bench-obb.xapk"
+    with open(files["apk"], "wb") as f:
+        f.write(make_apk(package, size))
+    manifest = {"xapk_version": 2, "package_name": package, "version_code": "2", "min_sdk_version": "21",
+                "target_sdk_version": "33", "split_apks": [{"file": package+".apk", "id": "base"}]}
+    manifest["split_apks"].extend({"file": f"config.{i}.apk", "id": f"config.{i}"} for i in configs)
+    with ZipFile(files["xapk"], "w") as zip_file:
+        zip_file.writestr("manifest.json", json_dumps(manifest))
+        zip_file.writestr(package+".apk", base)
+        for i in configs:
+            zip_file.writestr(f"config.{i}.apk", split_apk[i])
+    with ZipFile(files["apkm"], "w") as zip_file:
+        zip_file.writestr("info.json", json_dumps({"pname": package, "versioncode": 2, "min_api": 21,
+                                                   "arches": [i.replace("_", "-") for i in configs if i in abi_list]}))
+        zip_file.writestr("base.apk", base)
+        for i in configs:
+            zip_file.writestr(f"split_config.{i}.apk", split_apk[i])
+    with ZipFile(files["apks"], "w") as zip_file:
+        zip_file.writestr("toc.pb", toc(configs))
+        zip_file.writestr("splits/base-master.apk", base)
+        for i in configs:
+            zip_file.writestr(f"splits/base-{i}.apk", split_apk[i])
+    obb_manifest = {**manifest, "split_apks": [], "expansions": [
+        {"file": f"Android/obb/{package}/main.2.{package}.obb", "install_location": "EXTERNAL_STORAGE",
+         "install_path": f"Android/obb/{package}/main.2.{package}.obb"}]}
+    with ZipFile(files["obb"], "w") as zip_file:
+        zip_file.writestr("manifest.json", json_dumps(obb_manifest))
+        zip_file.writestr(package+".apk", make_apk(package, size))
+        zip_file.writestr(obb_manifest["expansions"][0]["file"], random.randbytes(obb))
+    return files
+
+
+def toc(configs: List[str]) -> bytes:
+    """apks 的 toc.pb：一个 sdk 21 的版本，base 模块，每个配置分包一个 ApkDescription"""
+    def varint(n: int) -> bytes:
+        out = b""
+        while n > 0x7F:
+            out += bytes([n & 0x7F | 0x80])
+            n >>= 7
+        return out + bytes([n])
+
+    def field(number: int, value) -> bytes:
+        if isinstance(value, int):
+            return varint(number << 3) + varint(value)
+        value = value.encode("utf-8") if isinstance(value, str) else value
+        return varint(number << 3 | 2) + varint(len(value)) + value
+
+    abi = {"armeabi_v7a": 2, "arm64_v8a": 3, "x86": 4, "x86_64": 5}
+    density = {"mdpi": 3, "hdpi": 5, "xhdpi": 6, "xxhdpi": 7, "xxxhdpi": 8}
+    apks = [field(2, field(2, "splits/base-master.apk") + field(3, field(2, 1)))]
+    for i in configs:
+        if i in abi:
+            targeting = field(1, field(1, field(1, abi[i])))
+        elif i in density:
+            targeting = field(4, field(1, field(1, density[i])))
+        else:
+            targeting = field(3, field(1, i))
+        apks.append(field(2, field(1, targeting) + field(2, f"splits/base-{i}.apk") + field(3, field(1, "config."+i))))
+    apk_set = field(2, field(1, field(1, "base") + field(6, 1)) + b"".join(apks))
+    variant = field(1, field(1, field(1, field(1, field(1, 21))))) + apk_set + field(3, 0)
+    return field(1, variant)
+
+
+# ========================= 假设备 =========================
+def fake_adb(work: Path, devices: int, latency: float, bandwidth: float) -> str:
+    """写入假 adb 的配置，返回可执行文件的路径"""
+    props = {"ro.product.cpu.abi": "arm64-v8a", "ro.product.cpu.abilist": "arm64-v8a,armeabi-v7a,armeabi",
+             "ro.build.version.sdk": "33", "persist.sys.locale": "zh-CN", "ro.build.fingerprint": "bench/fake:13"}
+    conf = {"devices": {f"bench{i+1}": {"props": props, "density": 440} for i in range(devices)},
+            "latency": latency, "bandwidth": bandwidth, "state": str(work/"device"), "installed_version": 1}
+    with open(work/"fake_adb.json", "w", encoding="utf-8") as f:
+        json_dump(conf, f)
+    os.environ["FAKE_ADB_CONFIG"] = str(work/"fake_adb.json")
+    if os.name == "nt":
+        adb = work/"adb.bat"
+        adb.write_text(f'@"{sys.executable}" "{bench_dir/"fake_adb.py"}" %*\n', encoding="utf-8")
+    else:
+        adb = work/"adb"
+        adb.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{bench_dir/"fake_adb.py"}" "$@"\n', encoding="utf-8")
+        adb.chmod(0o755)
+    return str(adb)
+
+
+# ========================= 测试 =========================
+def run_case(x, root: Path, file: Path, devices: list) -> Dict[str, float]:
+    """安装一次，返回总耗时和各阶段耗时(秒)，同一阶段多次出现时相加"""
+    x.tracer.events.clear()
+    x._dump_cache.clear()
+    if os.path.exists(x.cache_path("manifest.db")):
+        os.remove(x.cache_path("manifest.db"))  # 每次都重新解析
+    start = time.perf_counter()
+    if not x.main(root, file, devices):
+        raise RuntimeError(f"安装失败：{file}")
+    result = {"total": time.perf_counter()-start}
+    for i in x.tracer.events:
+        result[i["name"]] = result.get(i["name"], 0)+i["dur"]/1e6
+    return result
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=float, default=50, help="安装包大小(MB)，默认 50")
+    parser.add_argument("--splits", type=int, default=9, help="配置分包数量，默认 9")
+    parser.add_argument("--obb", type=float, default=100, help="obb 大小(MB)，默认 100")
+    parser.add_argument("--devices", type=int, default=1, help="设备数量，默认 1")
+    parser.add_argument("--latency", type=float, default=10, help="每条 adb 命令的延迟(ms)，默认 10")
+    parser.add_argument("--bandwidth", type=float, default=0, help="传输速度(MB/s)，默认 0 不限制")
+    parser.add_argument("--repeat", type=int, default=3, help="每种安装包的次数，取最小值，默认 3")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="比基准慢多少算变慢，默认 0.2")
+    parser.add_argument("--save", action="store_true", help="保存为新的基准")
+    args = parser.parse_args()
+
+    work = bench_dir/"work"
+    os.makedirs(work, exist_ok=True)
+    name = (f"size{args.size:g}-splits{args.splits}-obb{args.obb:g}-devices{args.devices}"
+            f"-latency{args.latency:g}-bw{args.bandwidth:g}")
+    packages = work/"packages"/name
+    random.seed(name)
+    files = make_packages(packages, int(args.size*1024*1024), args.splits, int(args.obb*1024*1024))
+    adb = fake_adb(work, args.devices, args.latency/1000, args.bandwidth*1024*1024)
+    with open(work/"config.yaml", "w", encoding="utf-8") as f:
+        f.write(f"adb: '{adb}'\njava: ''\naapt: ''\ndevice-cache-ttl: 0\n")
+
+    os.chdir(work)
+    import xapkInstaller as x
+    logging.disable(logging.WARNING)  # 和不加 -l 时相同
+    x.tracer.enabled = True
+    sys.stdin = io.StringIO("y\n"*1000)  # 不应该有提问，以防万一
+    devices = x.get_devices()
+    result: Dict[str, Dict[str, float]] = {}
+    for case, file in files.items():
+        runs = [run_case(x, work, file, devices) for _ in range(args.repeat)]
+        result[case] = {k: min(i.get(k, 0) for i in runs) for k in runs[0]}
+
+    baseline_file = bench_dir/"baseline.json"
+    baseline = {}
+    if os.path.exists(baseline_file):
+        with open(baseline_file, encoding="utf-8") as f:
+            baseline = json_load(f).get(name, {})
+    regression = []
+    print(f"{name}\n{'安装包':<10}{'阶段':<24}{'耗时(s)':>10}{'基准(s)':>10}")
+    for case, phases in result.items():
+        for phase, seconds in sorted(phases.items(), key=lambda i: -i[1]):
+            base = baseline.get(case, {}).get(phase)
+            # 太短的阶段误差大，差距超过 10ms 才算
+            slow = base is not None and seconds > base*(1+args.tolerance) and seconds-base > 0.01
+            if slow:
+                regression.append(f"{case} {phase}")
+            base_str = "-" if base is None else f"{base:.3f}"
+            print(f"{case:<13}{phase:<26}{seconds:>10.3f}{base_str:>10}{'  变慢' if slow else ''}")
+
+    if args.save:
+        data = {}
+        if os.path.exists(baseline_file):
+            with open(baseline_file, encoding="utf-8") as f:
+                data = json_load(f)
+        data[name] = result
+        with open(baseline_file, "w", encoding="utf-8") as f:
+            json_dump(data, f, ensure_ascii=False, indent=2)
+        print(f"基准已保存到 {baseline_file}")
+    elif regression:
+        print(f"比基准慢：{', '.join(regression)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
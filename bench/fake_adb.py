@@ -0,0 +1,137 @@
+#! /usr/bin/python3
+# coding: utf-8
+"""性能测试用的假 adb，不需要手机。
+
+配置文件由环境变量 FAKE_ADB_CONFIG 指定(json)：
+    devices: {序列号: {"props": {...}, "density": 440}}
+    latency: 每条命令的延迟(秒)
+    bandwidth: 传输速度(字节/秒)，0 为不限制
+    state: 保存“设备上”文件的文件夹
+    installed_version: dumpsys package 返回的 versionCode
+"""
+import os
+import shlex
+import shutil
+import sys
+import time
+from hashlib import md5
+from json import load as json_load
+
+with open(os.environ["FAKE_ADB_CONFIG"], encoding="utf-8") as _f:
+    conf = json_load(_f)
+session = "1234567890"
+
+
+def device_path(serial: str, path: str) -> str:
+    """设备上的路径对应的本地文件"""
+    return os.path.join(conf["state"], serial, path.lstrip("/"))
+
+
+def transfer(size: int) -> None:
+    """按配置的带宽等待"""
+    if conf.get("bandwidth"):
+        time.sleep(size/conf["bandwidth"])
+
+
+def copy_stream(src, dst=None) -> int:
+    size = 0
+    for data in iter(lambda: src.read(1024*1024), b""):
+        size += len(data)
+        if dst:
+            dst.write(data)
+    transfer(size)
+    return size
+
+
+def file_md5(file: str) -> str:
+    m = md5()
+    with open(file, "rb") as f:
+        for data in iter(lambda: f.read(1024*1024), b""):
+            m.update(data)
+    return m.hexdigest()
+
+
+def shell(serial: str, line: str) -> int:
+    device = conf["devices"][serial]
+    if line.startswith("getprop") and "__DENSITY__" in line:
+        for k, v in device["props"].items():
+            print(f"[{k}]: [{v}]")
+        print(f"__DENSITY__\nPhysical density: {device['density']}")
+    elif line.startswith("getprop "):
+        print(device["props"].get(line.split()[1], ""))
+    elif "__PACKAGE__" in line:
+        for p in line.split(" in ", 1)[1].split(";", 1)[0].split():
+            print(f"__PACKAGE__{p}\n    versionCode={conf.get('installed_version', 1)} minSdk=21 targetSdk=33")
+            print(f"    primaryCpuAbi={device['props'].get('ro.product.cpu.abi', '')}")
+    elif "dumpsys package" in line or line.startswith("pm dump"):
+        print(f"    versionCode={conf.get('installed_version', 1)} minSdk=21 targetSdk=33")
+    elif "dumpsys window" in line:
+        print(f"  init=1080x2400 {device['density']}dpi")
+    elif line.startswith("pm install-create"):
+        print(f"Success: created install session [{session}]")
+    elif line.startswith("pm install-write") and line.endswith(" -"):
+        # pm install-write -S SIZE SESSION NAME -，从标准输入读取
+        print(f"Success: streamed {copy_stream(sys.stdin.buffer)} bytes")
+    elif line.startswith("pm install-write"):
+        for _ in line.split("&&"):
+            print("Success: streamed")
+    elif "cat >" in line:
+        # mkdir -p DIR && cat >[>] PATH
+        parts = shlex.split(line)
+        local = device_path(serial, parts[-1])
+        os.makedirs(os.path.dirname(local), exist_ok=True)
+        with open(local, "ab" if ">>" in parts else "wb") as f:
+            copy_stream(sys.stdin.buffer, f)
+    elif line.startswith("pm install-commit") or line.startswith("pm install-abandon"):
+        print("Success")
+    elif line.startswith("rm "):
+        for i in shlex.split(line)[1:]:
+            if not i.startswith("-") and os.path.isfile(device_path(serial, i)):
+                os.remove(device_path(serial, i))
+    elif line.startswith("stat ") or line.startswith("md5sum "):
+        for i in shlex.split(line)[1:]:
+            local = device_path(serial, i)
+            if i.startswith("/") and os.path.isfile(local):
+                print(f"{os.path.getsize(local)} {i}" if line.startswith("stat ") else f"{file_md5(local)}  {i}")
+    return 0
+
+
+def main(argv: list) -> int:
+    time.sleep(conf.get("latency", 0))
+    serial = next(iter(conf["devices"]))
+    if argv[:1] == ["-s"]:
+        serial, argv = argv[1], argv[2:]
+    cmd, args = argv[0], argv[1:]
+    if cmd == "--version":
+        print("Android Debug Bridge version 1.0.41 (fake)")
+    elif cmd == "start-server":
+        pass
+    elif cmd == "devices":
+        print("List of devices attached")
+        for i in conf["devices"]:
+            print(f"{i}\tdevice")
+    elif cmd == "shell":
+        return shell(serial, " ".join(args))
+    elif cmd == "push":
+        local = device_path(serial, args[1])
+        os.makedirs(os.path.dirname(local), exist_ok=True)
+        shutil.copyfile(args[0], local)
+        transfer(os.path.getsize(args[0]))
+        print(f"{args[0]}: 1 file pushed.")
+    elif cmd == "pull":
+        if not os.path.isfile(device_path(serial, args[0])):
+            print(f"adb: error: remote object '{args[0]}' does not exist", file=sys.stderr)
+            return 1
+        shutil.copyfile(device_path(serial, args[0]), args[1])
+        transfer(os.path.getsize(args[1]))
+    elif cmd in ["install", "install-multiple"]:
+        transfer(sum(os.path.getsize(i) for i in args if os.path.isfile(i)))
+        print("Success")
+    else:
+        print(f"adb: unknown command {cmd}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,168 @@
+#! /usr/bin/python3
+# coding: utf-8
+"""AdbClient 的测试，使用本地的假 adb server，不需要手机和 adb。
+
+    python -m pytest bench/test_adb_client.py
+"""
+import io
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import xapkInstaller as x  # noqa: E402
+
+serial = "fake1"
+
+
+class FakeServer:
+    """实现 host:devices、features、shell v2 和 sync: 的 STAT/SEND/RECV"""
+    def __init__(self):
+        self.files: dict[str, bytes] = {}  # 设备上的文件
+        self.stdin: dict[str, bytes] = {}  # 每条 shell 命令收到的标准输入
+        self.sock = socket.create_server(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self) -> None:
+        while True:
+            conn, _ = self.sock.accept()
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def read(self, conn: socket.socket, size: int) -> bytes:
+        data = b""
+        while len(data) < size:
+            chunk = conn.recv(size-len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def reply(self, conn: socket.socket, data: str) -> None:
+        conn.sendall(b"OKAY" + b"%04x" % len(data) + data.encode("utf-8"))
+
+    def handle(self, conn: socket.socket) -> None:
+        with conn:
+            try:
+                while True:
+                    service = self.read(conn, int(self.read(conn, 4), 16)).decode("utf-8")
+                    if service == "host:devices":
+                        return self.reply(conn, f"{serial}\tdevice\n")
+                    elif service.endswith(":features"):
+                        return self.reply(conn, "shell_v2,cmd")
+                    conn.sendall(b"OKAY")
+                    if service.startswith("shell,v2,raw:"):
+                        return self.shell(conn, service.split(":", 1)[1])
+                    elif service == "sync:":
+                        return self.sync(conn)
+            except EOFError:
+                pass
+
+    def shell(self, conn: socket.socket, cmd: str) -> None:
+        stdin = []
+        while True:
+            _id, size = struct.unpack("<BI", self.read(conn, 5))
+            data = self.read(conn, size)
+            if _id == 4:  # close-stdin
+                break
+            stdin.append(data)
+        self.stdin[cmd] = b"".join(stdin)
+        if cmd.startswith("sleep "):
+            # 每隔一段时间输出一行，用于测试逐行输出和超时
+            for i in range(3):
+                conn.sendall(struct.pack("<BI", 1, 2) + b"%d\n" % i)
+                time.sleep(float(cmd.split()[1]))
+            out, err, code = b"", b"", 0
+        elif cmd.startswith("pm install-write"):
+            out, err, code = f"Success: streamed {len(self.stdin[cmd])} bytes\n".encode("utf-8"), b"", 0
+        elif cmd.startswith("exit "):
+            out, err, code = b"", b"error\n", int(cmd.split()[1])
+        else:
+            out, err, code = cmd.encode("utf-8") + b"\n", b"", 0
+        for _id, data in [(1, out), (2, err), (3, bytes([code]))]:
+            if data:
+                conn.sendall(struct.pack("<BI", _id, len(data)) + data)
+
+    def sync(self, conn: socket.socket) -> None:
+        while True:
+            _id, size = struct.unpack("<4sI", self.read(conn, 8))
+            path = self.read(conn, size).decode("utf-8")
+            if _id == b"STAT":
+                mode = 0o100644 if path in self.files else 0
+                conn.sendall(b"STAT" + struct.pack("<III", mode, len(self.files.get(path, b"")), 0))
+            elif _id == b"SEND":
+                data = []
+                while True:
+                    _id, size = struct.unpack("<4sI", self.read(conn, 8))
+                    if _id == b"DONE":
+                        break
+                    data.append(self.read(conn, size))
+                self.files[path.rsplit(",", 1)[0]] = b"".join(data)
+                conn.sendall(b"OKAY" + struct.pack("<I", 0))
+            elif _id == b"RECV":
+                data = self.files[path]
+                for i in range(0, len(data), 64*1024):
+                    chunk = data[i:i+64*1024]
+                    conn.sendall(b"DATA" + struct.pack("<I", len(chunk)) + chunk)
+                conn.sendall(b"DONE" + struct.pack("<I", 0))
+
+
+server = FakeServer()
+client = x.AdbClient(port=server.port)
+
+
+def test_devices():
+    assert client.devices() == f"{serial}\tdevice\n"
+    run, msg = client.run("", ["devices"])
+    assert run.returncode == 0 and f"{serial}\tdevice" in msg
+
+
+def test_shell():
+    assert client.shell(serial, "echo hi") == (0, b"echo hi\n", b"")
+    assert client.shell(serial, "exit 3") == (3, b"", b"error\n")
+
+
+def test_shell_in():
+    data = os.urandom(3*1024*1024+5)
+    cmd = f"pm install-write -S {len(data)} 123 base -"
+    returncode, stdout, stderr = client.shell_in(serial, cmd, io.BytesIO(data))
+    assert server.stdin[cmd] == data
+    assert (returncode, stdout, stderr) == (0, f"Success: streamed {len(data)} bytes\n".encode("utf-8"), b"")
+
+
+def test_device_shell_in():
+    device = x.Device(serial, client)
+    run, msg = device.shell_in(["exit", "2"], io.BytesIO(b"abc"))
+    assert run.returncode == 2 and msg == "error\n"
+    assert device._write_stream("123", "config.xxhdpi", 4, io.BytesIO(b"abcd"))
+
+
+def test_push_pull(tmp_path):
+    data = os.urandom(200*1024)
+    (tmp_path/"a.obb").write_bytes(data)
+    run = client.run(serial, ["push", str(tmp_path/"a.obb"), "/sdcard/a.obb"])[0]
+    assert run.returncode == 0 and server.files["/sdcard/a.obb"] == data
+    run = client.run(serial, ["pull", "/sdcard/a.obb", str(tmp_path/"b.obb")])[0]
+    assert run.returncode == 0 and (tmp_path/"b.obb").read_bytes() == data
+    run, msg = client.run(serial, ["pull", "/sdcard/none", str(tmp_path/"c.obb")])
+    assert run.returncode == 1 and "does not exist" in msg
+
+
+def test_run_on_line():
+    lines = []
+    run, msg = client.run(serial, ["shell", "sleep", "0.3"], on_line=lambda line: lines.append((line, time.monotonic())))
+    assert run.returncode == 0 and [i[0] for i in lines] == ["0", "1", "2"]
+    assert lines[2][1]-lines[0][1] > 0.5  # 读到一行就调用，不等命令结束
+
+
+def test_run_timeout():
+    start = time.monotonic()
+    run, msg = client.run(serial, ["shell", "sleep", "0.4"], timeout=0.5)  # 一直有输出，但总时间超过
+    assert run.returncode == 1 and "命令超时" in msg
+    assert time.monotonic()-start < 1
+    run, msg = client.run_pipe(serial, ["sleep", "0.4"], io.BytesIO(b""), timeout=0.5)
+    assert run.returncode == 1 and "命令超时" in msg
@@ -0,0 +1,38 @@
+#! /usr/bin/python3
+# coding: utf-8
+"""Workspace 的测试，不需要手机和 adb。
+
+    python -m pytest bench/test_workspace.py
+"""
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import xapkInstaller as x  # noqa: E402
+
+
+def old_dir(path: Path) -> Path:
+    """创建一个修改时间在一小时前的文件夹"""
+    os.makedirs(path)
+    (path/"a.txt").write_text("a")
+    os.utime(path, (time.time()-3600, time.time()-3600))
+    return path
+
+
+def test_sweep_keeps_unrelated_folders(tmp_path, monkeypatch):
+    work = tmp_path/"mydata"
+    photos = old_dir(work/"photos")
+    notes = old_dir(work/"xapkInstaller"/"notes")
+    stale = old_dir(work/"xapkInstaller"/"123-20200101000000")
+    monkeypatch.setattr(x, "read_yaml", lambda name: {"work-dir": str(work), "ram-dir": False})
+    workspace = x.Workspace()
+    workspace.open(tmp_path)
+    try:
+        assert workspace.dirs["disk"].parent == work/"xapkInstaller"
+        assert (photos/"a.txt").exists() and (notes/"a.txt").exists()
+        assert not stale.exists()
+    finally:
+        workspace.close()
+    assert photos.exists() and notes.exists()
@@ -1,21 +1,51 @@
 #! /usr/bin/python3
 # coding: utf-8
+import atexit
 import logging
 import os
+import posixpath
 import shutil
+import socket
+import sqlite3
+import stat
+import struct
 import subprocess
 import sys
-from axmlparserpy.axmlprinter import AXMLPrinter
+import threading
+import time
 from chardet import detect
-from defusedxml.minidom import parseString
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
+from functools import wraps
 from hashlib import md5 as _md5
+from json import dump as json_dump
+from json import dumps as json_dumps
 from json import load as json_load
+from json import loads as json_loads
 from pathlib import Path
+from queue import Queue
 from re import findall as re_findall
+from re import ASCII
+from re import fullmatch as re_fullmatch
+from shlex import quote
 from shlex import split as shlex_split
-from typing import Any, List, NoReturn, Tuple, Union
+from typing import Any, BinaryIO, Callable, Iterator, List, NoReturn, Tuple, Union
 from yaml import safe_load
 from zipfile import ZipFile
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+class DeviceFormatter(logging.Formatter):
+    """多设备同时安装时，在每条日志前加上设备序列号"""
+    def format(self, record: logging.LogRecord) -> str:
+        msg = super().format(record)
+        if record.threadName != "MainThread":
+            return f"[{record.threadName}] {msg}"
+        return msg
 
 
 log = logging.getLogger(__name__)
@@ -23,20 +53,21 @@ log.setLevel(logging.DEBUG)
 
 handler1 = logging.FileHandler("log.txt", encoding="utf-8")
 handler1.setLevel(logging.DEBUG)
-formatter = logging.Formatter("%(asctime)s - %(funcName)s - line %(lineno)d - %(levelname)s: %(message)s")
+formatter = DeviceFormatter("%(asctime)s - %(funcName)s - line %(lineno)d - %(levelname)s: %(message)s")
 handler1.setFormatter(formatter)
 
 handler2 = logging.StreamHandler()
 handler2.setLevel(logging.INFO)
+handler2.setFormatter(DeviceFormatter())
 
 log.addHandler(handler1)
 log.addHandler(handler2)
 
 
 _abi = ["armeabi_v7a", "arm64_v8a", "armeabi", "x86_64", "x86", "mips64", "mips"]
-_language = ["ar", "bn", "de", "en", "et", "es", "fr", "hi", "in", "it",
-             "ja", "ko", "ms", "my", "nl", "pt", "ru", "sv", "th", "tl",
-             "tr", "vi", "zh"]
+# 纹理压缩格式(TCF)分包的后缀，其中 atc 和语言的格式相同
+_tcf = ["3dc", "astc", "atc", "dxt1", "etc1", "etc2", "latc", "paletted", "pvrtc", "s3tc"]
+_density = {"ldpi": 120, "mdpi": 160, "tvdpi": 213, "hdpi": 240, "xhdpi": 320, "xxhdpi": 480, "xxxhdpi": 640, "nodpi": 0}
 info_msg = {
     "bundletool": "bundletool 可在 "
                   "https://github.com/google/bundletool/releases"
@@ -44,41 +75,460 @@ info_msg = {
                   "并将其放置在 xapkInstaller 同一文件夹即可。",
     "sdktoolow": "安装失败：安卓版本过低！"
 }
-
-
-def tostr(bytes_: bytes) -> str:
-    encoding = detect(bytes_)["encoding"]
-    if not encoding:
-        encoding = "utf-8"
+# toc.pb 中的 Abi.AbiAlias 和 ScreenDensity.DensityAlias
+toc_abi = {1: "armeabi", 2: "armeabi-v7a", 3: "arm64-v8a", 4: "x86", 5: "x86_64", 6: "mips", 7: "mips64", 8: "riscv64"}
+toc_density = {1: 0, 2: 120, 3: 160, 4: 213, 5: 240, 6: 320, 7: 480, 8: 640}
+axml_attr = {0x0101020C: "minSdkVersion", 0x0101021B: "versionCode",
+             0x01010270: "targetSdkVersion", 0x0101055B: "isFeatureSplit"}
+_dump_cache: dict[Tuple[str, int, int], dict] = {}
+_dump_lock = threading.Lock()
+_manifest_ready = False  # manifest_db 是否已经建表
+_cache_lock = threading.Lock()
+_encoding: dict[str, str] = {}
+_input_lock = threading.Lock()
+_plans: dict[Tuple[str, str], dict] = {}  # 安装计划 {(安装包, 设备序列号): plan_package 的结果}
+_aab_lock = threading.Lock()
+_aab_locks: dict[str, threading.Lock] = {}  # 每个 cache/aab 中的 apks 一个锁，本次运行用过的不会被清理
+_tools: dict[Tuple[str, str], str] = {}
+_tools_lock = threading.RLock()
+_yaml_cache: dict[str, Tuple[int, dict]] = {}
+options = {"converge": False, "trace": False}  # 命令行参数
+# 各命令默认的超时时间(秒)，可以在 config.yaml 的 command-timeout 中修改，0 为不限制
+# adb shell-in 为通过标准输入传输数据的 adb shell（流式安装、推送数据包）
+_timeout = {"adb devices": 60, "adb start-server": 60, "adb shell": 300, "adb exec-out": 300,
+            "adb push": 3600, "adb pull": 3600, "adb install": 3600, "adb install-multiple": 3600,
+            "adb shell-in": 3600, "java build-apks": 3600, "java install-apks": 3600}
+output_limit = 16*1024*1024  # 每条命令的标准输出、错误输出各保留的字节数
+
+
+def tostr(bytes_: bytes, key: str = "") -> str:
+    """先按 utf-8 解码，失败时才检测编码，检测结果按 key（工具、设备）记住"""
     try:
-        return bytes_.decode(encoding)
-    except UnicodeDecodeError:
         return bytes_.decode("utf-8")
+    except UnicodeDecodeError:
+        pass
+    encoding = _encoding.get(key)
+    if encoding:
+        try:
+            return bytes_.decode(encoding)
+        except UnicodeDecodeError:
+            pass
+    # 只检测开头的一部分，pm dump 之类的输出可能有几百 KB
+    encoding = detect(bytes_[:64*1024])["encoding"] or "utf-8"
+    if key:
+        _encoding[key] = encoding
+    return bytes_.decode(encoding, "replace")
+
+
+class AdbError(Exception):
+    pass
+
+
+class AdbClient:
+    """直接使用 adb server 的 smart socket 协议，不再每条命令启动一次 adb"""
+    commands = ["devices", "exec-out", "pull", "push", "shell"]
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.host = host
+        self.port = port or int(os.environ.get("ANDROID_ADB_SERVER_PORT", 5037))
+        self._features: dict[str, List[str]] = {}
+        self._lock = threading.Lock()
+        self._pool: dict[str, List[socket.socket]] = {}  # 每个设备空闲的 sync 连接
+        self._watch: dict[int, Tuple[List[socket.socket], threading.Event]] = {}  # 每个线程受 _deadline 限制的连接
+
+    # ===================================================
+    def _connect(self, service: str, serial: str = "", timeout: float = 0) -> socket.socket:
+        """timeout 为连接建立后每次读写最多等待的秒数，0 为不限制"""
+        sock = socket.create_connection((self.host, self.port), timeout=10)
+        sock.settimeout(timeout or None)  # 安装、推送可能需要很长时间
+        self._track(sock)
+        try:
+            if not service.startswith("host"):
+                self._send(sock, f"host:transport:{serial}" if serial else "host:transport-any")
+            self._send(sock, service)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def _read(self, sock: socket.socket, size: int) -> bytes:
+        data = b""
+        while len(data) < size:
+            chunk = sock.recv(size-len(data))
+            if not chunk:
+                raise AdbError("adb server 连接中断")
+            data += chunk
+        return data
+
+    def _read_all(self, sock: socket.socket, on_data: Union[Callable[[bytes], None], None] = None) -> bytes:
+        """读到连接关闭，最多保留 output_limit 字节，每读到一段就交给 on_data"""
+        buffer = OutputBuffer(output_limit)
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return buffer.getvalue()
+            buffer.append(chunk)
+            if on_data:
+                on_data(chunk)
+
+    def _read_string(self, sock: socket.socket) -> str:
+        return tostr(self._read(sock, int(self._read(sock, 4), 16)))
+
+    def _send(self, sock: socket.socket, service: str) -> None:
+        data = service.encode("utf-8")
+        sock.sendall(b"%04x" % len(data) + data)
+        status = self._read(sock, 4)
+        if status != b"OKAY":
+            raise AdbError(self._read_string(sock) if status == b"FAIL" else f"未知的返回 {status!r}")
+
+    @contextmanager
+    def _deadline(self, timeout: float) -> Iterator[threading.Event]:
+        """与 run_cmd 相同，timeout 为命令总的最长时间。到时关闭当前线程在其中打开的连接，阻塞的读写立即出错"""
+        ident = threading.get_ident()
+        sockets: List[socket.socket] = []
+        timed_out = threading.Event()
+
+        def kill() -> None:
+            timed_out.set()
+            for sock in list(sockets):
+                self._shutdown(sock)
+
+        self._watch[ident] = (sockets, timed_out)
+        timer = threading.Timer(timeout, kill) if timeout else None
+        if timer:
+            timer.daemon = True
+            timer.start()
+        try:
+            yield timed_out
+        finally:
+            if timer:
+                timer.cancel()
+            del self._watch[ident]
+            if timed_out.is_set():  # 已关闭的 sync 连接不能再放回连接池
+                with self._lock:
+                    for i in self._pool.values():
+                        i[:] = [sock for sock in i if sock not in sockets]
+
+    def _shutdown(self, sock: socket.socket) -> None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _track(self, sock: socket.socket) -> None:
+        if threading.get_ident() in self._watch:
+            sockets, timed_out = self._watch[threading.get_ident()]
+            sockets.append(sock)
+            if timed_out.is_set():
+                self._shutdown(sock)
+
+    # ===================================================
+    def devices(self) -> str:
+        with self._connect("host:devices") as sock:
+            return self._read_string(sock)
+
+    def exec_out(self, serial: str, cmd: str, timeout: float = 0,
+                 on_data: Union[Callable[[bytes], None], None] = None) -> bytes:
+        with self._connect("exec:"+cmd, serial, timeout) as sock:
+            return self._read_all(sock, on_data)
+
+    def features(self, serial: str) -> List[str]:
+        if serial not in self._features:
+            with self._connect(f"host-serial:{serial}:features" if serial else "host:features") as sock:
+                self._features[serial] = self._read_string(sock).split(",")
+        return self._features[serial]
+
+    def shell(self, serial: str, cmd: str, timeout: float = 0,
+              on_output: Union[Callable[[int, bytes], None], None] = None) -> Tuple[int, bytes, bytes]:
+        """on_output(1 或 2, data) 在每次读到标准输出或错误输出时调用"""
+        if "shell_v2" not in self.features(serial):
+            with self._connect("shell:"+cmd, serial, timeout) as sock:
+                return 0, self._read_all(sock, (lambda data: on_output(1, data)) if on_output else None), b""
+        with self._connect("shell,v2,raw:"+cmd, serial, timeout) as sock:
+            sock.sendall(struct.pack("<BI", 4, 0))  # 关闭设备端的标准输入
+            return self._shell_read(sock, on_output)
+
+    def shell_in(self, serial: str, cmd: str, src: BinaryIO, timeout: float = 0) -> Tuple[int, bytes, bytes]:
+        """src 的内容写入设备端命令的标准输入。adb server 不会转发 shutdown(SHUT_WR)，
+        exec: 无法让设备端知道输入已结束，所以只能用 shell v2 的 stdin(id 0) 和 close-stdin(id 4)"""
+        if "shell_v2" not in self.features(serial):
+            raise AdbError("设备不支持 shell v2，无法通过标准输入传输")
+        result: List[Union[Tuple[int, bytes, bytes], BaseException]] = []
+
+        def reader() -> None:
+            try:
+                result.append(self._shell_read(sock))
+            except BaseException as err:
+                result.append(err)
+
+        with self._connect("shell,v2,raw:"+cmd, serial, timeout) as sock:
+            # 同时读取输出，设备端命令输出较多时不会卡住
+            thread = threading.Thread(target=reader, name=threading.current_thread().name, daemon=True)
+            thread.start()
+            try:
+                for data in iter(lambda: src.read(32*1024), b""):
+                    sock.sendall(struct.pack("<BI", 0, len(data)) + data)
+                sock.sendall(struct.pack("<BI", 4, 0))
+            except (BrokenPipeError, ConnectionResetError):
+                log.warning("写入中断")  # 设备端命令提前退出，退出码由 reader 读取
+            thread.join()
+        if isinstance(result[0], BaseException):
+            raise result[0]
+        return result[0]
+
+    def _shell_read(self, sock: socket.socket, on_output: Union[Callable[[int, bytes], None], None] = None
+                    ) -> Tuple[int, bytes, bytes]:
+        """shell v2: id(1) + length(4, little-endian) + data，可以拿到退出码。输出与 run_cmd 相同最多保留 output_limit 字节"""
+        buffers = {1: OutputBuffer(output_limit), 2: OutputBuffer(output_limit)}
+        returncode = 0
+        while True:
+            try:
+                _id, size = struct.unpack("<BI", self._read(sock, 5))
+            except AdbError:
+                break
+            data = self._read(sock, size)
+            if _id in buffers:
+                buffers[_id].append(data)
+                if on_output:
+                    on_output(_id, data)
+            elif _id == 3:
+                returncode = data[0]
+                break
+        return returncode, buffers[1].getvalue(), buffers[2].getvalue()
+
+    # ===================================================
+    def _sync(self, serial: str, timeout: float = 0) -> socket.socket:
+        with self._lock:
+            if self._pool.get(serial):
+                sock = self._pool[serial].pop()
+                sock.settimeout(timeout or None)
+                self._track(sock)
+                return sock
+        return self._connect("sync:", serial, timeout)
+
+    def _release(self, serial: str, sock: socket.socket) -> None:
+        with self._lock:
+            self._pool.setdefault(serial, []).append(sock)
+
+    def _sync_request(self, sock: socket.socket, _id: bytes, path: str) -> None:
+        data = path.encode("utf-8")
+        sock.sendall(_id + struct.pack("<I", len(data)) + data)
+
+    def _stat(self, sock: socket.socket, remote: str) -> int:
+        self._sync_request(sock, b"STAT", remote)
+        _id, mode, size, mtime = struct.unpack("<4sIII", self._read(sock, 16))
+        return mode
+
+    def _list(self, sock: socket.socket, remote: str) -> List[Tuple[str, int]]:
+        self._sync_request(sock, b"LIST", remote)
+        entries = []
+        while True:
+            _id, mode, size, mtime, namelen = struct.unpack("<4sIIII", self._read(sock, 20))
+            if _id == b"DONE":
+                return entries
+            name = self._read(sock, namelen).decode("utf-8")
+            if name not in [".", ".."]:
+                entries.append((name, mode))
+
+    def _recv(self, sock: socket.socket, remote: str, local: str) -> None:
+        self._sync_request(sock, b"RECV", remote)
+        with open(local, "wb") as f:
+            while True:
+                _id, size = struct.unpack("<4sI", self._read(sock, 8))
+                if _id == b"DATA":
+                    f.write(self._read(sock, size))
+                elif _id == b"DONE":
+                    return
+                else:
+                    raise AdbError(tostr(self._read(sock, size)))
+
+    def _send_file(self, sock: socket.socket, local: str, remote: str) -> int:
+        self._sync_request(sock, b"SEND", f"{remote},{0o644}")
+        total = 0
+        with open(local, "rb") as f:
+            while True:
+                chunk = f.read(64*1024)  # 协议规定每个 DATA 最大 64K
+                if not chunk:
+                    break
+                sock.sendall(b"DATA" + struct.pack("<I", len(chunk)) + chunk)
+                total += len(chunk)
+        sock.sendall(b"DONE" + struct.pack("<I", int(os.path.getmtime(local))))
+        _id, size = struct.unpack("<4sI", self._read(sock, 8))
+        if _id != b"OKAY":
+            raise AdbError(tostr(self._read(sock, size)))
+        return total
+
+    def pull(self, serial: str, remote: str, local: str, timeout: float = 0) -> str:
+        sock = self._sync(serial, timeout)
+        try:
+            mode = self._stat(sock, remote)
+            if not mode:
+                raise AdbError(f"adb: error: remote object '{remote}' does not exist")
+            if os.path.isdir(local):
+                local = os.path.join(local, posixpath.basename(remote.rstrip("/")))
+            count = self._pull(sock, remote, local, mode)
+        except Exception:
+            sock.close()
+            raise
+        self._release(serial, sock)
+        return f"{remote}: {count} file(s) pulled."
+
+    def _pull(self, sock: socket.socket, remote: str, local: str, mode: int) -> int:
+        if not stat.S_ISDIR(mode):
+            self._recv(sock, remote, local)
+            return 1
+        os.makedirs(local, exist_ok=True)
+        count = 0
+        for name, _mode in self._list(sock, remote):
+            count += self._pull(sock, posixpath.join(remote, name), os.path.join(local, name), _mode)
+        return count
+
+    def push(self, serial: str, local: str, remote: str, timeout: float = 0) -> str:
+        sock = self._sync(serial, timeout)
+        try:
+            if stat.S_ISDIR(self._stat(sock, remote)):
+                remote = posixpath.join(remote, os.path.basename(local))
+            total = self._send_file(sock, local, remote)
+        except Exception:
+            sock.close()
+            raise
+        self._release(serial, sock)
+        return f"{local}: 1 file pushed. {total} bytes"
+
+    # ===================================================
+    def run(self, serial: str, cmd: List[str], timeout: Union[float, None] = None,
+            on_line: Union[Callable[[str], None], None] = None):
+        """与 run_msg 返回值相同，供 Device.adb 使用。
+        timeout 与 run_cmd 相同为命令总的最长时间，on_line 在读到每一行时调用"""
+        log.info(["adb-server", serial, *cmd])
+        if timeout is None:
+            timeout = command_timeout("adb "+cmd[0])
+        splitters = [LineSplitter(on_line, serial), LineSplitter(on_line, serial)] if on_line else []
+
+        def on_output(_id: int, data: bytes) -> None:
+            splitters[_id-1].feed(data)
+
+        returncode, stdout, stderr = 0, b"", b""
+        with tracer.span("adb-server "+cmd[0], cmd=cmd) as span, self._deadline(timeout) as timed_out:
+            try:
+                if cmd[0] == "devices":
+                    stdout = ("List of devices attached\n"+self.devices()).encode("utf-8")
+                elif cmd[0] == "shell":
+                    returncode, stdout, stderr = self.shell(serial, " ".join(cmd[1:]), 0,
+                                                            on_output if on_line else None)
+                elif cmd[0] == "exec-out":
+                    stdout = self.exec_out(serial, " ".join(cmd[1:]), 0,
+                                           (lambda data: on_output(1, data)) if on_line else None)
+                elif cmd[0] == "push":
+                    stdout = self.push(serial, str(cmd[1]), str(cmd[2])).encode("utf-8")
+                    span["bytes"] = path_size(cmd[1])
+                elif cmd[0] == "pull":
+                    stdout = self.pull(serial, str(cmd[1]), str(cmd[2])).encode("utf-8")
+                    span["bytes"] = path_size(cmd[2])
+            except (AdbError, OSError) as err:
+                returncode, stderr = 1, str(err).encode("utf-8")
+        if on_line:
+            if cmd[0] not in ["shell", "exec-out"]:
+                splitters[0].feed(stdout)
+            for i in splitters:
+                i.close()
+        if timed_out.is_set():
+            log.error(f"命令超过 {timeout:g} 秒，已结束：{cmd}")
+            returncode, stderr = 1, f"命令超时({timeout:g}秒)".encode("utf-8")
+        run = subprocess.CompletedProcess(cmd, returncode, stdout, stderr)
+        if run.stderr:
+            return run, tostr(run.stderr, serial)
+        if run.stdout:
+            return run, tostr(run.stdout, serial)
+        return run, str()
+
+    def run_pipe(self, serial: str, cmd: List[str], src: BinaryIO, timeout: Union[float, None] = None):
+        """与 run_pipe 返回值相同，供 Device.shell_in 使用。timeout 与 run_cmd 相同为命令总的最长时间"""
+        log.info(["adb-server", serial, "shell", *cmd])
+        if timeout is None:
+            timeout = command_timeout("adb shell-in")
+        with tracer.span("adb-server shell-in", cmd=cmd) as span, self._deadline(timeout) as timed_out:
+            start = src.tell() if src.seekable() else 0
+            try:
+                run = subprocess.CompletedProcess(cmd, *self.shell_in(serial, " ".join(cmd), src))
+            except (AdbError, OSError) as err:
+                run = subprocess.CompletedProcess(cmd, 1, b"", str(err).encode("utf-8"))
+            if src.seekable():
+                span["bytes"] = src.tell()-start
+        if timed_out.is_set():
+            log.error(f"命令超过 {timeout:g} 秒，已结束：{cmd}")
+            run = subprocess.CompletedProcess(cmd, 1, run.stdout, f"命令超时({timeout:g}秒)".encode("utf-8"))
+        if run.stderr:
+            return run, tostr(run.stderr, serial)
+        return run, tostr(run.stdout, serial) if run.stdout else str()
 
 
 class Device:
-    __slots__ = ["ADB", "_abi", "_abilist", "_dpi", "_drawable", "_locale", "_sdk", "device"]
+    __slots__ = ["ADB", "_abi", "_abilist", "_dpi", "_drawable", "_locale", "_packages", "_props", "_sdk", "client", "device"]
 
-    def __init__(self, device: str = ""):
+    def __init__(self, device: str = "", client: Union["AdbClient", None] = None):
         self.ADB: str = "adb"
+        self.client = client  # 配置了 adb-server 时直接和 adb server 通信
         self._abi = None
         self._abilist = None
-        self._dpi = -1
-        self._drawable = [""]
+        self._dpi = 0
+        self._drawable: List[str] = []
         self._locale = None
+        self._packages: dict[str, dict] = {}
+        self._props: dict[str, str] = {}
         self._sdk = 0
         self.device = device  # 连接多个设备时使用
 
+    @property
+    def props(self) -> dict:
+        if not self._props:
+            self.getprops()
+        return self._props
+
+    def getprops(self) -> dict:
+        """一次 adb 调用获取全部属性和屏幕密度，结果按序列号缓存在本地"""
+        ttl = int(read_yaml("config.yaml").get("device-cache-ttl", 86400))
+        fingerprint = ""
+        if ttl > 0 and self.device:
+            # 系统更新后 fingerprint 会改变，缓存随之失效
+            fingerprint = self.shell(["getprop", "ro.build.fingerprint"])[1].strip()
+            profile = read_cache("device.json").get(self.device, {})
+            if fingerprint and profile.get("fingerprint") == fingerprint and time.time()-profile.get("time", 0) < ttl:
+                log.info(f"使用缓存的设备信息 {self.device}")
+                self._props = profile["props"]
+                self._dpi = profile["dpi"]
+                return self._props
+        # wm density: Physical density: 440 / Override density: 480
+        run, msg = self.shell(["getprop;", "echo", "__DENSITY__;", "wm", "density"])
+        if run.returncode:
+            sys.exit(msg)
+        props, density = msg.split("__DENSITY__", 1) if "__DENSITY__" in msg else (msg, "")
+        for i in props.split("\n"):
+            i = i.strip()
+            if i.startswith("[") and "]: [" in i:
+                key, value = i[1:-1].split("]: [", 1)
+                self._props[key] = value
+        for i in density.strip().split("\n"):
+            if "density:" in i:
+                try:
+                    self._dpi = int(i.split(":")[1])  # Override 在 Physical 之后，优先使用
+                except ValueError:
+                    pass
+        if fingerprint:
+            profile = {"fingerprint": fingerprint, "time": time.time(), "props": self._props, "dpi": self.dpi}
+            update_cache("device.json", self.device, profile)
+        return self._props
+
     @property
     def abi(self) -> str:
         if not self._abi:
-            self._abi = self.shell(["getprop", "ro.product.cpu.abi"])[1].strip()
+            self._abi = self.props.get("ro.product.cpu.abi", "")
         return self._abi
 
     @property
     def abilist(self) -> list:
         if not self._abilist:
-            self._abilist = self.shell(["getprop", "ro.product.cpu.abilist"])[1].strip().split(",")
+            self._abilist = self.props.get("ro.product.cpu.abilist", self.abi).split(",")
         return self._abilist
 
     @property
@@ -88,6 +538,9 @@ class Device:
         return self._dpi
 
     def getdpi(self) -> int:
+        if self.props and self._dpi:
+            return self._dpi
+        # 没有 wm 命令的旧设备
         _dpi = self.shell(["dumpsys", "window", "displays"])[1]
         for i in _dpi.strip().split("\n"):
             if i.find("dpi") >= 0:
@@ -121,9 +574,19 @@ class Device:
     @property
     def locale(self) -> str:
         if not self._locale:
-            self._locale = self.shell(["getprop", "ro.product.locale"])[1].strip().split("-")[0]
+            for i in ["persist.sys.locale", "ro.product.locale", "ro.product.locale.language"]:
+                if self.props.get(i):
+                    self._locale = self.props[i].split("-")[0]
+                    break
         return self._locale
 
+    @property
+    def locales(self) -> List[str]:
+        """需要安装的语言：设备语言，以及 config.yaml 中的 locales"""
+        locales = [self.props[i].split("-")[0] for i in ["persist.sys.locale", "ro.product.locale"] if self.props.get(i)]
+        locales.extend(str(i) for i in read_yaml("config.yaml").get("locales") or [])
+        return list(dict.fromkeys(i for i in locales+[self.locale] if i))
+
     @property
     def sdk(self) -> int:
         if not self._sdk:
@@ -134,28 +597,80 @@ class Device:
         __sdk = ["ro.build.version.sdk", "ro.product.build.version.sdk",
                  "ro.system.build.version.sdk", "ro.system_ext.build.version.sdk"]
         for i in __sdk:
-            _sdk = self.shell(["getprop", i])[1].strip()
+            _sdk = self.props.get(i)
             if _sdk:
                 try:
                     self._sdk = int(_sdk)
                     break
-                except ValueError as err:
-                    # 设备断开连接 error: closed
-                    sys.exit("设备断开连接")
+                except ValueError:
+                    sys.exit(f"无法识别的安卓版本：{_sdk!r}")
+        if not self._sdk:
+            # 设备断开连接 error: closed
+            sys.exit("设备断开连接")
         return self._sdk
 
+    def package_info(self, package_name: str) -> dict:
+        """已安装应用的 versionCode 和 primaryCpuAbi，未安装时为空
+
+        结果只使用一次，之后通常会安装这个应用，旧的信息就没用了
+        """
+        if package_name not in self._packages:
+            self.prefetch_packages([package_name])
+        return self._packages.pop(package_name, {})
+
+    def prefetch_packages(self, package_list: List[str]) -> dict:
+        """一次 adb 调用查询多个应用，只取需要的几行，不再传输完整的 pm dump"""
+        cmd = ["for", "p", "in", *package_list, ";", "do", "echo", "__PACKAGE__$p;"]
+        if self.sdk >= 23:  # toybox 自带 grep
+            cmd.extend(["dumpsys", "package", "$p", "|", "grep", "-e", "versionCode=", "-e", "primaryCpuAbi=;"])
+        else:
+            cmd.extend(["pm", "dump", "$p;"])
+        cmd.append("done")
+        msg = self.shell(cmd)[1]
+        for i in package_list:
+            self._packages[i] = {}
+        for i in msg.split("__PACKAGE__")[1:]:
+            lines = i.split("\n")
+            info = self._packages.setdefault(lines[0].strip(), {})
+            for line in lines[1:]:
+                line = line.strip()
+                # 同一个应用可能有多段信息（如系统应用的更新），只取第一段
+                if "versionCode=" in line and "versionCode" not in info:
+                    info["versionCode"] = int(line.split("versionCode=")[1].split(" ")[0])
+                elif line.startswith("primaryCpuAbi=") and "primaryCpuAbi" not in info:
+                    info["primaryCpuAbi"] = line.split("=")[1]
+        log.info({i: self._packages.get(i) for i in package_list})
+        return self._packages
+
     # ===================================================
-    def adb(self, cmd: list):
+    def adb(self, cmd: list, timeout: Union[float, None] = None, on_line: Union[Callable[[str], None], None] = None):
+        """timeout、on_line 见 run_cmd"""
+        if self.client and cmd[0] in AdbClient.commands:
+            return self.client.run(self.device, cmd, timeout, on_line)
         c = [self.ADB]
         if self.device:
             c.extend(["-s", self.device])
         c.extend(cmd)
-        return run_msg(c)
+        return run_msg(c, timeout, on_line)
 
-    def shell(self, cmd: list):
+    def shell(self, cmd: list, timeout: Union[float, None] = None, on_line: Union[Callable[[str], None], None] = None):
         c = ["shell"]
         c.extend(cmd)
-        return self.adb(c)
+        return self.adb(c, timeout, on_line)
+
+    def shell_in(self, cmd: list, src: BinaryIO, timeout: Union[float, None] = None):
+        """adb shell，src 的内容原样写入设备端命令的标准输入。
+        需要 shell v2(安卓 7.0)，才能传递标准输入的结束并返回退出码；exec-in 不返回任何输出"""
+        if timeout is None:
+            timeout = command_timeout("adb shell-in")
+        if self.client:
+            return self.client.run_pipe(self.device, cmd, src, timeout)
+        c = [self.ADB]
+        if self.device:
+            c.extend(["-s", self.device])
+        c.append("shell")
+        c.extend(cmd)
+        return run_pipe(c, src, timeout)
 
     # ===================================================
     def _abandon(self, SESSION_ID: str):
@@ -165,97 +680,473 @@ class Device:
             log.info(msg)
 
     def _commit(self, SESSION_ID: str):
+        """提交失败时中止安装，由调用者决定是否重试"""
         run, msg = self.shell(["pm", "install-commit", SESSION_ID])
         if run.returncode:
+            log.error(msg)
             self._abandon(SESSION_ID)
-            sys.exit(msg)
         else:
             log.info(msg)
         return run
 
-    def _create(self) -> str:
-        run, msg = self.shell(["pm", "install-create"])
+    def _create(self, *option: str) -> str:
+        run, msg = self.shell(["pm", "install-create", *option])
         if run.returncode:
             sys.exit(msg)
         log.info(msg)  # Success: created install session [1234567890]
         return msg.strip()[:-1].split("[")[1]
 
     def _del(self, info):
-        for i in info:
-            run, msg = self.shell(["rm", i["path"]])
-            if run.returncode:
-                sys.exit(msg)
+        """一次删除所有临时文件"""
+        run, msg = self.shell(["rm", "-f", *[i["path"] for i in info]])
+        if run.returncode:
+            sys.exit(msg)
 
     def _push(self, file_list: list) -> List[dict]:
-        info = []
-        for f in file_list:
-            info.append({"name": "_".join(f.rsplit(".")[:-1]), "path": "/data/local/tmp/"+f})
-            run, msg = self.adb(["push", f, info[-1]["path"]])
+        """同时推送多个文件到 /data/local/tmp"""
+        info = [{"name": os.path.splitext(os.path.basename(f))[0], "path": "/data/local/tmp/"+os.path.basename(f),
+                 "size": os.path.getsize(f)} for f in file_list]
+        with ThreadPoolExecutor(max_workers=min(4, len(info)), thread_name_prefix=self.device or "push") as pool:
+            result = list(pool.map(lambda f, i: self.adb(["push", f, i["path"]]), file_list, info))
+        for run, msg in result:
             if run.returncode:
+                self._del(info)
                 sys.exit(msg)
         return info
 
     def _write(self, SESSION_ID: str, info: list):
-        index = 0
-        for i in info:
-            # pm install-write SESSION_ID SPLIT_NAME PATH
-            run, msg = self.shell(["pm", "install-write",
-                                   SESSION_ID, i["name"], i["path"]])
-            if run.returncode:
-                self._abandon(SESSION_ID)
-                sys.exit(msg)
-            index += 1
+        # pm install-write -S SIZE SESSION_ID SPLIT_NAME PATH，所有文件在一次 shell 中写入
+        cmd = " && ".join(f"pm install-write -S {i['size']} {SESSION_ID} {i['name']} {i['path']}" for i in info)
+        run, msg = self.shell([cmd])
+        if run.returncode:
+            self._abandon(SESSION_ID)
+            sys.exit(msg)
+        log.info(msg)
 
+    def _write_stream(self, SESSION_ID: str, name: str, size: int, src: BinaryIO) -> bool:
+        """不经过 /data/local/tmp，直接把 src 写入安装会话，失败时由调用者中止安装"""
+        # pm install-write -S SIZE SESSION_ID SPLIT_NAME -
+        run, msg = self.shell_in(["pm", "install-write", "-S", str(size), SESSION_ID, quote(name), "-"], src)
+        if run.returncode or "Success" not in tostr(run.stdout, self.device):
+            log.error(msg)
+            return False
+        log.info(msg.strip())  # Success: streamed 123456 bytes
+        return True
 
-def build_apkm_config(device: Device, file_list: List[str], install: List[str]) -> Tuple[dict, List[str]]:
-    abi = [f"split_config.{i}.apk" for i in _abi]
-    language = [f"split_config.{i}.apk" for i in _language]
-    config: dict[str, Any] = {"language": []}
-    for i in file_list:
-        if i == f"split_config.{device.abi.replace('-', '_')}.apk":
-            config["abi"] = i
-        for d in device.drawable:
-            if i == f"split_config.{d}.apk":
-                config["drawable"] = i
-        if i == f"split_config.{device.locale}.apk":
-            config["language"].insert(0, i)
-        elif (i in abi) or (i.find("dpi.apk") >= 0):
-            config[i.split(".")[1]] = i
-        elif i in language:
-            config["language"].append(i)
-        elif i.endswith(".apk"):
-            install.append(i)
-    log.info(config)
-    return config, install
-
-
-def build_xapk_config(device: Device, split_apks: List[dict[str,str]], install: List[str]) -> Tuple[dict[str, List[str]|str|dict[str,str]], List[str]]:
-    abi = [f"config.{i}" for i in _abi]
-    language = [f"config.{i}" for i in _language]
-    config: dict[str, List[str]|str|dict[str,str]] = {"language": []}
-    log.info(f"config.{device.abi.replace('-', '_')}")
-    for i in split_apks:
-        if i["id"] == f"config.{device.abi.replace('-', '_')}":
-            config["abi"] = i["file"]  #  最佳的一个
-        for d in device.drawable:
-            if i["file"] == f"split_config.{d}.apk":
-                config["drawable"] = i
-        if i["id"] == f"config.{device.locale}":
-            config["language"].insert(0, i["file"])
-        elif (i["id"] in abi) or i["id"].endswith("dpi"):
-            config[i["id"].split(".")[1]] = i["file"]
-        elif i["id"] in language:
-            config["language"].append(i["file"])
+
+class DiskBudget:
+    """限制临时文件占用的空间，单个文件超过限制时也可以处理，但不与其他文件同时占用"""
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, size: int) -> None:
+        with self.cond:
+            while self.used and self.used + size > self.limit:
+                self.cond.wait()
+            self.used += size
+
+    def release(self, size: int) -> None:
+        with self.cond:
+            self.used -= size
+            self.cond.notify_all()
+
+    def try_acquire(self, size: int) -> bool:
+        """不等待，空间不够时返回 False"""
+        with self.cond:
+            if self.used + size > self.limit:
+                return False
+            self.used += size
+            return True
+
+
+class OutputBuffer:
+    """命令输出只保留开头和结尾各 limit/2 字节，中间的部分丢弃"""
+    def __init__(self, limit: int):
+        self.half = limit//2
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.dropped = 0
+
+    def append(self, data: bytes) -> None:
+        if len(self.head) < self.half:
+            size = self.half-len(self.head)
+            self.head += data[:size]
+            data = data[size:]
+        self.tail += data
+        if len(self.tail) > 2*self.half:  # 超过两倍才裁剪，避免每次都移动
+            self.dropped += len(self.tail)-self.half
+            del self.tail[:-self.half]
+
+    def getvalue(self) -> bytes:
+        if len(self.tail) > self.half:
+            self.dropped += len(self.tail)-self.half
+            del self.tail[:-self.half]
+        if self.dropped:
+            return bytes(self.head) + f"\n...省略 {self.dropped} 字节...\n".encode("utf-8") + bytes(self.tail)
+        return bytes(self.head + self.tail)
+
+
+class LineSplitter:
+    """分段读到的输出每凑够一行就交给 on_line，run_cmd 和 AdbClient 共用"""
+    def __init__(self, on_line: Callable[[str], None], key: str):
+        self.on_line = on_line
+        self.key = key
+        self.line = b""
+
+    def feed(self, data: bytes) -> None:
+        *lines, self.line = (self.line+data).split(b"\n")
+        if len(self.line) > 64*1024:  # 没有换行的进度输出
+            lines.append(self.line)
+            self.line = b""
+        for i in lines:
+            self.on_line(tostr(i, self.key).rstrip("\r"))
+
+    def close(self) -> None:
+        if self.line:
+            self.on_line(tostr(self.line, self.key).rstrip("\r"))
+            self.line = b""
+
+
+class Tracer:
+    """--trace/--profile：记录各阶段和每条命令的耗时、数据量，保存为 Chrome trace event 格式，
+    可以用 chrome://tracing 或 https://ui.perfetto.dev 打开"""
+    def __init__(self):
+        self.enabled = False
+        self.events: List[dict] = []
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def span(self, name: str, **args: Any) -> Iterator[dict]:
+        """args 中的 bytes 为数据量，可以在 with 中修改"""
+        if not self.enabled:
+            yield args
+            return
+        begin = time.perf_counter()
+        try:
+            yield args
+        finally:
+            end = time.perf_counter()
+            thread = threading.current_thread()
+            with self.lock:
+                self.events.append({"name": name, "ph": "X", "ts": (begin-self.start)*1e6, "dur": (end-begin)*1e6,
+                                    "pid": os.getpid(), "tid": thread.ident, "thread": thread.name,
+                                    "args": {k: v if isinstance(v, (int, float)) else str(v) for k, v in args.items()}})
+
+    def wrap(self, func: Callable) -> Callable:
+        """以函数名记录整个函数的耗时"""
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not self.enabled:
+                return func(*args, **kwargs)
+            with self.span(func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def save(self, file: str) -> None:
+        threads = {i["tid"]: i.pop("thread") for i in self.events}
+        events = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": k, "args": {"name": v}}
+                  for k, v in threads.items()]
+        with open(file, "w", encoding="utf-8") as f:
+            json_dump({"traceEvents": events+self.events, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+
+    def summary(self) -> str:
+        """按名称汇总：次数，总耗时，数据量"""
+        total: dict[str, List[float]] = {}
+        for i in self.events:
+            t = total.setdefault(i["name"], [0, 0, 0])
+            t[0] += 1
+            t[1] += i["dur"]/1e6
+            t[2] += i["args"].get("bytes", 0)
+        lines = [f"{'阶段':<24}{'次数':>6}{'耗时(s)':>12}{'数据量':>14}"]
+        for name, (count, dur, size) in sorted(total.items(), key=lambda i: -i[1][1]):
+            lines.append(f"{name:<26}{count:>8}{dur:>14.3f}{size_str(size) if size else '-':>17}")
+        return "\n".join(lines)
+
+
+class Workspace:
+    """所有临时文件的根目录。每次运行一个文件夹 work/xapkInstaller/<pid>-<时间>，每个安装包一个子文件夹，安装后删除。
+    不超过 ram-threshold(MB) 的安装包放在内存文件系统(ram-dir，Linux 默认 /dev/shm)中，
+    磁盘和内存各有一个 DiskBudget。运行期间锁定文件夹中的 lock 文件，启动时删除没有锁定的文件夹(异常退出留下的)"""
+    def __init__(self):
+        self.dirs: dict[str, Path] = {}  # 本次运行的文件夹 {"disk": ..., "ram": ...}
+        self.budget: dict[str, DiskBudget] = {}
+        self.threshold = 0
+        self._count = 0
+        self._files: dict[str, Path] = {}  # 安装包 -> 所在的子文件夹
+        self._lock = threading.Lock()
+        self._locks: List[BinaryIO] = []
+
+    def open(self, root: Path) -> None:
+        """创建本次运行的文件夹并清理之前留下的，只执行一次"""
+        with self._lock:
+            if self.dirs:
+                return
+            conf = read_yaml("config.yaml")
+            # work-dir 可能是已有的文件夹，和 ram-dir 一样只使用其中的 xapkInstaller 文件夹
+            roots = {"disk": Path(root, conf.get("work-dir") or "work", "xapkInstaller").resolve()}
+            ram = self._ram_root(conf.get("ram-dir"))
+            if ram:
+                roots["ram"] = ram
+            name = f"{os.getpid()}-{time.strftime('%Y%m%d%H%M%S')}"
+            for kind, path in roots.items():
+                try:
+                    os.makedirs(path, exist_ok=True)
+                    self.sweep(path)
+                    os.makedirs(path/name)
+                    self._locks.append(self._lock_dir(path/name))
+                except OSError as err:
+                    if kind == "disk":
+                        raise
+                    log.warning(f"无法使用内存文件系统 {path}：{err}")
+                    continue
+                self.dirs[kind] = path/name
+            self.budget["disk"] = DiskBudget(int(conf.get("disk-budget", 4096))*1024*1024)
+            if "ram" in self.dirs:
+                free = shutil.disk_usage(self.dirs["ram"]).free
+                self.budget["ram"] = DiskBudget(min(int(conf.get("ram-budget", 1024))*1024*1024, free//2))
+            self.threshold = int(conf.get("ram-threshold", 256))*1024*1024
+            atexit.register(self.close)
+        log.info(f"临时文件夹：{list(map(str, self.dirs.values()))}")
+
+    def close(self) -> None:
+        with self._lock:
+            for i in self._locks:
+                i.close()
+            self._locks.clear()
+            for i in self.dirs.values():
+                delPath(i)
+            self.dirs.clear()
+
+    def _lock_dir(self, path: Path) -> BinaryIO:
+        """锁定 path/lock，进程退出(包括被结束)时系统会释放锁；已被锁定时抛出 OSError"""
+        f = open(path/"lock", "a+b")
+        try:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            f.close()
+            raise
+        f.write(f"{os.getpid()}\n".encode("utf-8"))
+        f.flush()
+        return f
+
+    def _ram_root(self, ram_dir: Union[str, bool, None]) -> Union[Path, None]:
+        """ram-dir 为 false 时不使用内存文件系统，为空时使用 /dev/shm(如果有)"""
+        if ram_dir is False:
+            return None
+        if not ram_dir:
+            if not (os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK)):
+                return None
+            ram_dir = "/dev/shm"
+        return Path(ram_dir, "xapkInstaller")
+
+    def sweep(self, path: Path) -> None:
+        """删除 path 中异常退出的进程留下的文件夹，只删除 open 创建的 <pid>-<时间> 文件夹"""
+        for i in os.scandir(path):
+            if not i.is_dir(follow_symlinks=False) or not re_fullmatch(r"\d+-\d{14}", i.name):
+                continue
+            if not os.path.exists(os.path.join(i.path, "lock")):
+                if time.time()-i.stat().st_mtime < 60:  # 可能刚创建，还没有锁定
+                    continue
+            else:
+                try:
+                    self._lock_dir(Path(i.path)).close()
+                except OSError:
+                    continue  # 正在使用
+            log.info(f"删除之前留下的临时文件夹：{i.path}")
+            delPath(Path(i.path))
+
+    # ===================================================
+    def dir_of(self, file: Union[Path, str, None] = None) -> Path:
+        """安装包所在的子文件夹，不是 package() 创建的安装包时为本次运行的文件夹"""
+        with self._lock:
+            if str(file) in self._files:
+                return self._files[str(file)]
+        return self.dirs.get("disk") or Path.cwd()
+
+    def package(self, size: int) -> Tuple[Path, DiskBudget]:
+        """为安装包创建子文件夹并占用 size 字节的空间，不超过 ram-threshold 且内存还有空间时放在内存中"""
+        kind = "disk"
+        if "ram" in self.budget and size <= self.threshold and self.budget["ram"].try_acquire(size):
+            kind = "ram"
         else:
-            install.append(i["file"])
-    log.info(config)
-    return config, install
+            self.budget["disk"].acquire(size)
+        with self._lock:
+            self._count += 1
+            path = self.dirs[kind]/str(self._count)
+        os.makedirs(path)
+        return path, self.budget[kind]
+
+    def register(self, file: Path, path: Path) -> None:
+        """get_unpack_path 会把 file 解压到 path"""
+        with self._lock:
+            self._files[str(file)] = path
+
+    def release(self, item: dict) -> None:
+        """删除安装包的子文件夹，释放占用的空间"""
+        with self._lock:
+            for k, v in list(self._files.items()):
+                if v == item.get("dir"):
+                    del self._files[k]
+        if item.get("dir"):
+            delPath(item["dir"])
+        if item.get("budget"):
+            item["budget"].release(item["size"])
+            item["size"] = 0
+
+    def temp(self) -> Path:
+        """不属于某个安装包的临时文件放在本次运行的文件夹中"""
+        return self.dirs.get("disk") or Path.cwd()
+
+
+tracer = Tracer()
+workspace = Workspace()
+
+
+@tracer.wrap
+def aab_apks(device: Device, file: str) -> Path:
+    """aab 为这个设备生成的 apks，保存在 cache/aab 中"""
+    name_suffix = cmd_path(file)
+    conf = read_yaml("./config.yaml")
+    sign = {}
+    if conf.get("ks") and conf.get("ks-pass") and conf.get("ks-key-alias") and conf.get("key-pass"):
+        sign = {i: conf[i] for i in ["ks", "ks-pass", "ks-key-alias", "key-pass"]}
+    spec = device_spec(device)
+    # 相同的 aab、签名和设备规格只需要生成一次，型号相同的设备共用
+    key = md5(json_dumps([file_digest(file), sign, spec], sort_keys=True))
+    apks = Path(cache_path("aab"), key+".apks").resolve()
+    with _aab_lock:
+        lock = _aab_locks.setdefault(key, threading.Lock())
+    with lock:  # 规格不同的设备可以同时生成
+        if os.path.exists(apks):
+            log.info(f"使用缓存的 apks：{apks}")
+            os.utime(apks)  # 按最后使用时间清理
+        else:
+            aab_build(name_suffix, apks, spec, sign)
+            trim_aab_cache()
+    return apks
+
+
+def aab_build(bundle: str, apks: Path, spec: dict, sign: dict) -> None:
+    """bundletool build-apks，先写临时文件，完成后再放到 apks"""
+    os.makedirs(os.path.dirname(apks), exist_ok=True)
+    # 临时文件放在 workspace，异常退出时下次启动会删除
+    name = os.path.splitext(os.path.basename(apks))[0]
+    spec_file = os.path.join(workspace.temp(), f"{name}.{threading.get_ident()}.json")
+    tmp = os.path.join(workspace.temp(), f"{name}.{threading.get_ident()}.apks")
+    with open(spec_file, "w", encoding="utf-8") as f:
+        json_dump(spec, f)
+    build = [check_sth("java"), "-jar", check_sth("bundletool"), "build-apks",
+             "--device-spec="+spec_file, "--bundle="+bundle, "--output="+tmp]
+    build.extend(f"--{k}={v}" for k, v in sign.items())
+    try:
+        run, msg = run_msg(build, on_line=log.debug)  # build-apks 可能需要几分钟，进度实时写入日志
+        if run.returncode:
+            if "failed to deserialize resources.pb" in msg:
+                log.error("请升级bundletool.jar！")
+                sys.exit(info_msg["bundletool"])
+            else:
+                sys.exit(msg)
+        shutil.move(tmp, apks)
+    finally:
+        for i in [spec_file, tmp]:
+            if os.path.exists(i):
+                os.remove(i)
+
 
+def apks_package(zip_file: ZipFile, files: List[str]) -> str:
+    """apks 的包名，从要安装的 base-master.apk 或 standalone apk 中读取，不需要解压"""
+    name = next((i for i in files if i.endswith("base-master.apk")), files[0])
+    with zip_file.open(name) as f, ZipFile(f) as apk, apk.open("AndroidManifest.xml") as axml:
+        return read_axml(axml)["package"]
 
-def check(ADB=None) -> List[str]:
+
+def ask(prompt: str) -> str:
+    """多设备同时安装时，同一时间只会有一个提问。--converge 或标准输入已关闭时按默认(否)回答"""
+    name = threading.current_thread().name
+    if name != "MainThread":
+        prompt = f"[{name}] {prompt}"
+    if options["converge"]:  # 由脚本调用，不等待输入
+        log.warning(f"--converge，按默认回答：{prompt}")
+        return ""
+    with _input_lock:
+        try:
+            return input(prompt)
+        except EOFError:
+            log.warning(f"无法读取输入，按默认回答：{prompt}")
+            return ""
+
+
+def axml_string(pool: bytes, index: int) -> str:
+    """从字符串池中读取第 index 个字符串"""
+    # header: type(2) headerSize(2) size(4) stringCount(4) styleCount(4) flags(4) stringsStart(4) stylesStart(4)
+    _, header_size, _, count, _, flags, start, _ = struct.unpack_from("<HHIIIIII", pool)
+    if index >= count:
+        return ""
+    offset = start + struct.unpack_from("<I", pool, header_size+index*4)[0]
+    if flags & 0x100:  # UTF-8：字符数，字节数，内容
+        offset += 2 if pool[offset] & 0x80 else 1
+        size = pool[offset]
+        if size & 0x80:
+            size = ((size & 0x7F) << 8) | pool[offset+1]
+            offset += 1
+        return pool[offset+1:offset+1+size].decode("utf-8", "replace")
+    size = struct.unpack_from("<H", pool, offset)[0]  # UTF-16：字符数，内容
+    offset += 2
+    if size & 0x8000:
+        size = ((size & 0x7FFF) << 16) | struct.unpack_from("<H", pool, offset)[0]
+        offset += 2
+    return pool[offset:offset+size*2].decode("utf-16-le", "replace")
+
+
+def backup_object(root: Path, _md5sum: str) -> str:
+    """备份的文件按 md5 保存，不同设备、不同版本的相同文件只保存一份"""
+    return os.path.join(root, "backup", "objects", _md5sum[:2], _md5sum)
+
+
+def best_density(density: List[int], dpi: int) -> int:
+    """优先不低于设备的最小密度，没有时取最大的"""
+    density = [i for i in density if i]
+    higher = [i for i in density if i >= dpi]
+    return min(higher) if higher else max(density or [0])
+
+
+@tracer.wrap
+def build_plan(files: List[Path], devices: List[Device]) -> List[dict]:
+    """安装前先算出每个安装包在每个设备上要安装哪些文件，以及传输量"""
+    plan = []
+    for file in files:
+        for device in devices:
+            try:
+                plan.append(get_plan(device, file))
+            except Exception as err:
+                log.exception("Failed in build_plan.")
+                plan.append({"file": str(file), "device": device.device, "package": "",
+                             "files": [], "bytes": 0, "action": f"error: {err!r}"})
+    for device in devices:
+        package_list = sorted({i["package"] for i in plan if i["device"] == device.device and i["package"]})
+        if package_list:
+            device.prefetch_packages(package_list)  # 每个设备只查询一次
+    return plan
+
+
+def cache_path(name: str) -> str:
+    """缓存文件路径，和 config.yaml 一样放在工具所在的文件夹"""
+    dir_path = os.path.join(os.getcwd(), "cache")
+    os.makedirs(dir_path, exist_ok=True)
+    return os.path.join(dir_path, name)
+
+
+def check(ADB=None, client: Union[AdbClient, None] = None) -> List[str]:
     if not ADB:
         ADB = check_sth("adb")
-    run, msg = run_msg([ADB, "devices"])
+    run, msg = client.run("", ["devices"]) if client else run_msg([ADB, "devices"])
     _devices = msg.strip().split("\n")[1:]
     if _devices == ["* daemon started successfully"]:
         log.info("初次启动adb服务")
@@ -278,29 +1169,64 @@ def check(ADB=None) -> List[str]:
     return devices
 
 
+def check_client(ADB: str) -> Union[AdbClient, None]:
+    """配置了 adb-server 时使用 AdbClient，adb server 未启动时先启动"""
+    if not read_yaml("config.yaml").get("adb-server"):
+        return None
+    client = AdbClient()
+    for _ in range(2):
+        try:
+            client.devices()
+            return client
+        except (AdbError, OSError) as err:
+            log.info(f"无法连接 adb server：{err}")
+            run_msg([ADB, "start-server"])
+    log.warning("无法连接 adb server，将使用 adb 命令")
+    return None
+
+
 def check_sth(key: str, conf="config.yaml"):
+    """查找工具的路径，每个进程只查找一次"""
     if key not in ["adb", "java", "aapt", "bundletool"]:
         return ""
     conf = read_yaml(conf)
     path: str = conf.get(key, key)
-    if not os.path.exists(path):
-        # 配置文件有误或为空时，使用系统环境中的adb
+    with _tools_lock:
+        if (key, path) not in _tools:
+            _tools[(key, path)] = path if os.path.exists(path) else probe_tool(key)
+        return _tools[(key, path)]
+
+
+def probe_tool(key: str) -> str:
+    """配置文件有误或为空时，使用系统环境中的工具。
+    检测结果按工具路径和修改时间保存到 cache/tools.json，下次启动不再检测"""
+    if key == "bundletool":
+        binary = os.path.abspath(key+".jar") if os.path.isfile(key+".jar") else None
+    else:
+        binary = shutil.which(key)
+    if not binary:
+        log.error(f"未配置{key}")
+        return ""
+    cache_key = f"{key}|{binary}|{os.stat(binary).st_mtime_ns}"
+    version = read_cache("tools.json").get(cache_key)
+    if version is None:
         try:
             if key in ["adb", "java"]:
                 run, msg = run_msg([key, "--version"])
             elif key in ["aapt"]:
                 run, msg = run_msg([key, "v"])
             elif key in ["bundletool"]:
-                run, msg = run_msg([check_sth("java"), "-jar", key+".jar", "version"])
+                run, msg = run_msg([check_sth("java"), "-jar", binary, "version"])
         except FileNotFoundError:
             run = None
-        if run and (run.returncode == 0):
-            log.info(f"check_sth({key!r})")
-            log.info(msg.strip())
-            return key
-        log.error(f"未配置{key}")
-        return ""
-    return path
+        if not (run and (run.returncode == 0)):
+            log.error(f"未配置{key}")
+            return ""
+        version = msg.strip()
+        update_cache("tools.json", cache_key, version)
+    log.info(f"check_sth({key!r})")
+    log.info(version)
+    return binary if key == "bundletool" else key
 
 
 def check_by_manifest(device: Device, manifest: dict) -> None:
@@ -322,63 +1248,118 @@ def check_by_manifest(device: Device, manifest: dict) -> None:
         log.exception("Failed in check_by_manifest->findabi.")
 
 
+def checkout_backup(root: Path, manifest: dict) -> Path:
+    """用硬链接把备份清单中的文件按原来的文件名放到一个临时文件夹，不复制文件"""
+    dir_path = Path(workspace.temp(), md5(f"{manifest['package']}{manifest['time']}{threading.get_ident()}"),
+                    manifest["package"]).resolve()
+    os.makedirs(dir_path, exist_ok=True)
+    for i in manifest["files"]:
+        obj, dst = backup_object(root, i["md5"]), os.path.join(dir_path, i["name"])
+        try:
+            os.link(obj, dst)
+        except OSError:
+            shutil.copyfile(obj, dst)
+    return dir_path
+
+
+@tracer.wrap
+def check_unchanged(device: Device, file: Path) -> bool:
+    """--converge：设备上已安装的 apk 和将要安装的文件完全相同，数据包也都会被 push_expansions 跳过时返回 True"""
+    suffix = os.path.splitext(file)[1]
+    if suffix == ".aab":  # 和安装时一样比较生成的 apks，已缓存时不会重新生成
+        file = aab_apks(device, str(file))
+        suffix = ".apks"
+    plan = get_plan(device, file)
+    files, expansions = plan["files"], []
+    if plan["action"] == "install + push":
+        files = files[:1]
+        expansions = read_xapk_manifest(file)["expansions"]
+    if not files or not all(i.endswith(".apk") for i in files):
+        return False
+    package = plan["package"]
+    if not package and suffix == ".apks":
+        with ZipFile(file) as zip_file:
+            package = apks_package(zip_file, files)
+    if not package:
+        return False
+    # 一次 shell 计算所有已安装 apk 的 md5
+    run = device.shell([f"for f in $(pm path {package}); do md5sum ${{f#package:}}; done"])[0]
+    remote = sorted(i.split()[0] for i in tostr(run.stdout, device.device).strip().split("\n") if i.strip())
+    if len(remote) != len(files) or sorted(member_md5(file, i) for i in files) != remote:
+        return False
+    if not expansions:
+        return True
+    # 和 push_expansions 相同，设备上已有大小和 md5 都相同的文件时跳过
+    paths = {"/storage/emulated/0/"+i["install_path"]: i["file"] for i in expansions}
+    remote_size = remote_stat(device, list(paths))
+    if any(remote_size.get(k) != member_size(file, v) for k, v in paths.items()):
+        return False
+    run = device.shell(["md5sum", *[quote(i) for i in paths], "2>/dev/null"])[0]
+    remote_md5 = {}
+    for line in tostr(run.stdout, device.device).strip().split("\n"):
+        if "  " in line:
+            _md5sum, path = line.strip().split("  ", 1)
+            remote_md5[path] = _md5sum
+    return all(remote_md5.get(k) == member_md5(file, v) for k, v in paths.items())
+
+
+def check_xapk(device: Device, manifest: dict, install: List[str]) -> None:
+    if device.sdk < int(manifest["min_sdk_version"]):
+        sys.exit(info_msg["sdktoolow"])
+    elif device.sdk > int(manifest["target_sdk_version"]):
+        log.info("警告：安卓版本过高！可能存在兼容性问题！")
+    abi = [i for i in install[2:] if i.split(".")[-2] in _abi]
+    checkVersion(device, manifest["package_name"], int(manifest.get("version_code") or 0), abi=" ".join(abi))
+
+
+@tracer.wrap
 def checkVersion(device: Device, package_name: str, fileVersionCode: int, versionCode: int = -1, abi: str = "") -> None:
     if type(fileVersionCode) is str:
         fileVersionCode = int(fileVersionCode)
     if type(versionCode) is str:
         versionCode = int(versionCode)
-    msg = device.shell(["pm", "dump", package_name])[1]
-    for i in msg.split("\n"):
-        if "versionCode" in i:
-            versionCode = int(i.strip().split("=")[1].split(" ")[0])
-            if versionCode == -1:
-                input("警告：首次安装需要在手机上点击允许安装！按回车继续...")
-            elif fileVersionCode < versionCode:
-                if input("警告：降级安装？请确保文件无误！(y/N)").lower() != "y":
-                    sys.exit("降级安装，用户取消安装。")
-            elif fileVersionCode == versionCode:
-                if input("警告：版本一致！请确保文件无误！(y/N)").lower() != "y":
-                    sys.exit("版本一致，用户取消安装。")
-        elif "primaryCpuAbi" in i:
-            primaryCpuAbi = i.strip().split("=")[1]
-            if (primaryCpuAbi == "arm64-v8a" and len(abi) > 0) and (primaryCpuAbi.replace("-", "_") not in abi):
-                if input("警告：从64位变更到32位？请确保文件无误！(y/N)").lower() != "y":
-                    sys.exit("用户取消安装。")
-
-
-def config_abi(config: dict, install: List[str], abilist: List[str]):
-    if config.get("abi"):
-        install.append(config["abi"])
-    else:
-        for i in abilist:
-            i = i.replace("-", "_")
-            if config.get(i):
-                install.append(config[i])
-                break
-    return config, install
+    info = device.package_info(package_name)
+    if "versionCode" in info:
+        versionCode = info["versionCode"]
+        if versionCode == -1:
+            ask("警告：首次安装需要在手机上点击允许安装！按回车继续...")
+        elif fileVersionCode < versionCode:
+            if ask("警告：降级安装？请确保文件无误！(y/N)").lower() != "y":
+                sys.exit("降级安装，用户取消安装。")
+        elif fileVersionCode == versionCode:
+            # --converge 时 check_unchanged 已确认文件不同，直接重新安装
+            if not options["converge"] and ask("警告：版本一致！请确保文件无误！(y/N)").lower() != "y":
+                sys.exit("版本一致，用户取消安装。")
+    if "primaryCpuAbi" in info:
+        primaryCpuAbi = info["primaryCpuAbi"]
+        if (primaryCpuAbi == "arm64-v8a" and abi) and (primaryCpuAbi.replace("-", "_") not in abi):
+            if ask("警告：从64位变更到32位？请确保文件无误！(y/N)").lower() != "y":
+                sys.exit("用户取消安装。")
+
+
+def cmd_path(file: Path) -> str:
+    """命令行中使用的路径，尽量使用相对路径，避免路径中其他部分的特殊字符"""
+    try:
+        return os.path.relpath(file)
+    except ValueError:  # Windows 下不在同一个盘符
+        return str(file)
 
 
-def config_drawable(config: dict, install: List[str]):
-    if config.get("drawable"):
-        install.append(config["drawable"])
-    else:
-        _drawableList = ["xxxhdpi", "xxhdpi", "xhdpi", "hdpi", "tvdpi", "mdpi", "ldpi", "nodpi"]
-        for i in _drawableList:
-            if config.get(i):
-                install.append(config[i])
-                break
-    return config, install
+def command_name(cmd: List[str]) -> str:
+    """trace 中命令的名称：adb shell，java build-apks"""
+    name, args = os.path.splitext(os.path.basename(str(cmd[0])))[0], [str(i) for i in cmd[1:]]
+    while args[:1] in [["-s"], ["-jar"]]:
+        args = args[2:]
+    return f"{name} {args[0]}" if args else name
 
 
-def config_language(config: dict, install: List[str]):
-    if config.get("language"):
-        # 如果有设备语言一致的语言包，会优先安装
-        install.append(config["language"][0])
-    else:
-        log.warning("找不到任意一种语言包！！")
-    return config, install
+def command_timeout(name: str) -> float:
+    """命令的超时时间(秒)，name 为 command_name 的结果，0 为不限制"""
+    conf = read_yaml("config.yaml").get("command-timeout") or {}
+    return float(conf.get(name, _timeout.get(name, 600)))
 
 
+@tracer.wrap
 def copy_files(copy: List[Path]):
     log.info("copy_files start")
     if os.path.exists(copy[1]):
@@ -391,18 +1372,49 @@ def copy_files(copy: List[Path]):
     log.info("copy_files end")
 
 
+@tracer.wrap
 def delPath(path: Path):
-    if not os.path.exists(path):
+    if not os.path.lexists(path):
         log.info(f"文件(夹)不存在 {path!r}")
         return
-    if os.path.isfile(path):
+    if os.path.islink(path) or os.path.isfile(path):
         log.info(f"删除文件 {path!r}")
         return os.remove(path)
     log.info(f"删除文件夹 {path!r}")
     return shutil.rmtree(path)
 
 
+def device_spec(device: Device) -> dict:
+    """bundletool 的 --device-spec，由设备信息生成，不需要 get-device-spec"""
+    locale = ""
+    for i in ["persist.sys.locale", "ro.product.locale"]:
+        if device.props.get(i):
+            locale = device.props[i]
+            break
+    # 设备语言在前，之后是 config.yaml 中的 locales，和 resolve_splits 相同
+    locales = [locale] if locale else []
+    locales.extend(i for i in device.locales if i != locale.split("-")[0])
+    return {"supportedAbis": device.abilist, "supportedLocales": locales or ["en"],
+            "screenDensity": device.dpi, "sdkVersion": device.sdk}
+
+
+@tracer.wrap
 def dump(file: Path, del_path: List[Path]) -> dict:
+    """同一个文件只解析一次，多设备安装时共用结果，解析结果会保存到本地"""
+    _stat = os.stat(file)
+    key = (os.path.abspath(file), _stat.st_size, _stat.st_mtime_ns)
+    with _dump_lock:
+        if key not in _dump_cache:
+            cache_key = manifest_key(file)  # 读取文件首尾，只计算一次
+            manifest = get_manifest_cache(file, cache_key)
+            if manifest is None:
+                manifest = dump_aapt(file, del_path)
+                set_manifest_cache(cache_key, manifest)
+            _dump_cache[key] = manifest
+        return _dump_cache[key]
+
+
+def dump_aapt(file: Path, del_path: List[Path]) -> dict:
     _aapt = check_sth("aapt")
     if len(_aapt) > 0:
         run, msg = run_msg([_aapt, "dump", "badging", str(file)])
@@ -433,25 +1445,20 @@ def dump(file: Path, del_path: List[Path]) -> dict:
 
 
 def dump_py(file_path: Path, del_path: List[Path]) -> dict:
-    _path = os.path.join(os.getcwd(), get_unpack_path(file_path))
-    del_path.append(Path(_path).resolve())
     zip_file = ZipFile(file_path)
-    upfile = "AndroidManifest.xml"
-    zip_file.extract(upfile, del_path[-1])
-    with open(os.path.join(del_path[-1], upfile), "rb") as f:
-        data = f.read()
-    ap = AXMLPrinter(data)
-    buff = parseString(tostr(ap.getBuff()))
-    manifest = {}
-    _manifest = buff.getElementsByTagName("manifest")[0]
-    uses_sdk = buff.getElementsByTagName("uses-sdk")[0]
-    manifest["package_name"] = _manifest.getAttribute("package")
-    manifest["versionCode"] = int(_manifest.getAttribute("android:versionCode"))
-    manifest["min_sdk_version"] = int(uses_sdk.getAttribute("android:minSdkVersion"))
+    with zip_file.open("AndroidManifest.xml") as f:
+        axml = read_axml(f)
+    manifest: dict[str, Any] = {}
+    manifest["package_name"] = axml["package"]
+    manifest["versionCode"] = int(axml["versionCode"])
+    manifest["min_sdk_version"] = int(axml.get("minSdkVersion", 1))
     try:
-        manifest["target_sdk_version"] = int(uses_sdk.getAttribute("android:targetSdkVersion"))
-    except ValueError:
+        manifest["target_sdk_version"] = int(axml["targetSdkVersion"])
+    except KeyError:
         log.warning("`targetSdkVersion` no found.")
+    if axml.get("split"):
+        manifest["split"] = axml["split"]
+        manifest["is_feature_split"] = bool(axml.get("isFeatureSplit"))
     file_list = zip_file.namelist()
     native_code = []
     for i in file_list:
@@ -461,6 +1468,51 @@ def dump_py(file_path: Path, del_path: List[Path]) -> dict:
     return manifest
 
 
+def encoding_key(cmd: List[str]) -> str:
+    """同一个工具、同一个设备的输出编码通常不变"""
+    key = os.path.basename(cmd[0])
+    if "-s" in cmd[1:-1]:
+        key += ":"+cmd[cmd.index("-s")+1]
+    return key
+
+
+def extract_splits(device: Device, file: Path, zip_file: ZipFile, members: List[str], del_path: List[Path]) -> List[str]:
+    """prepare() 已经解压时直接使用各设备共用的文件，否则(流式安装失败)解压到这个设备自己的文件夹"""
+    shared = Path(get_unpack_path(file)).resolve()
+    if all(os.path.isfile(os.path.join(shared, i)) for i in members):
+        return [os.path.join(shared, i) for i in members]
+    _path = Path(get_unpack_path(file, device.device)).resolve()
+    del_path.append(_path)
+    return [zip_file.extract(i, _path) for i in members]
+
+
+def file_md5(file: Path, size: int = -1) -> str:
+    """文件前 size 字节的 md5，size 为 -1 时为整个文件"""
+    m = _md5()
+    with open(file, "rb") as f:
+        while size:
+            data = f.read(1024*1024 if size < 0 else min(size, 1024*1024))
+            if not data:
+                break
+            m.update(data)
+            if size > 0:
+                size -= len(data)
+    return m.hexdigest()
+
+
+def file_digest(file: Path, size: int = 1024*1024) -> str:
+    """只读取文件开头和结尾，apk 结尾是 zip 的中央目录，包含所有文件的 CRC"""
+    m = _md5()
+    file_size = os.path.getsize(file)
+    m.update(str(file_size).encode())
+    with open(file, "rb") as f:
+        m.update(f.read(size))
+        if file_size > size:
+            f.seek(max(size, file_size-size))
+            m.update(f.read(size))
+    return m.hexdigest()
+
+
 def findabi(native_code: List[str], abilist: List[str]) -> bool:
     for i in abilist:
         if i in native_code:
@@ -468,43 +1520,60 @@ def findabi(native_code: List[str], abilist: List[str]) -> bool:
     return False
 
 
-def get_unpack_path(file: Path) -> str:
-    """获取文件解压路径"""
-    dir_path, name_suffix = os.path.split(file)
-    name = os.path.splitext(name_suffix)[0]
-    unpack_path = os.path.join(dir_path, name)
+@tracer.wrap
+def get_devices() -> List[Device]:
+    """查找 adb 和已连接的设备，一次运行只需要调用一次"""
+    ADB: str = check_sth("adb")
+    client = check_client(ADB)
+    devices = [Device(i, client) for i in check(ADB, client)]
+    if len(devices) == 0:
+        sys.exit("安装失败：手机未连接电脑！")
+    for device in devices:
+        device.ADB = ADB
+    return devices
+
+
+def get_manifest_cache(file: Path, key: Tuple[int, str]) -> Union[dict, None]:
+    """从本地缓存中读取 dump 的结果，key 为 manifest_key(file)，没有时返回 None"""
+    try:
+        with closing(manifest_db()) as db:
+            row = db.execute("SELECT data FROM manifest WHERE size=? AND digest=?", key).fetchone()
+    except sqlite3.Error:
+        log.exception("Failed in get_manifest_cache.")
+        return None
+    if row:
+        log.info(f"使用缓存的解析结果 {file}")
+        return json_loads(row[0])
+    return None
+
+
+def get_plan(device: Device, file: Path) -> dict:
+    """安装计划中的一项，安装时按计划选择文件，不再重新选择；不在计划中时计算并加入计划"""
+    key = (str(file), device.device)
+    if key not in _plans:
+        _plans[key] = plan_package(device, file)
+    return _plans[key]
+
+
+def get_unpack_path(file: Path, device: str = "") -> str:
+    """获取文件解压路径，在安装包的临时文件夹中，多设备同时安装时每个设备使用不同的路径"""
+    # 输入文件可能没有复制，不能解压到原文件旁边
+    name = os.path.splitext(os.path.split(file)[1])[0]
+    unpack_path = os.path.join(workspace.dir_of(file), md5(name+device))
     return unpack_path
 
 
+@tracer.wrap
 def install_aab(device: Device, file: str, del_path: List[Path], root: Path) -> Tuple[List[str], bool]:
     """正式版是需要签名的，配置好才能安装"""
     log.info(install_aab.__doc__)
-    name_suffix = os.path.split(file)[1]
-    name = name_suffix.rsplit(".", 1)[0]
-    del_path.append(Path(name+".apks").resolve())
-    if os.path.exists(del_path[-1]):
-        delPath(del_path[-1])
-    build = [check_sth("java"), "-jar", check_sth("bundletool"), "build-apks",
-             "--connected-device", "--bundle="+name_suffix,
-             "--output="+str(del_path[-1])]
-    sign = read_yaml("./config.yaml")
-    if sign.get("ks") and sign.get("ks-pass") and sign.get("ks-key-alias") and sign.get("key-pass"):
-        for i in sign:
-            if i in ["ks", "ks-pass", "ks-key-alias", "key-pass"]:
-                build.append(f"--{i}={sign[i]}")
-    run, msg = run_msg(build)
-    if run.returncode:
-        if "failed to deserialize resources.pb" in msg:
-            log.error("请升级bundletool.jar！")
-            sys.exit(info_msg["bundletool"])
-        else:
-            sys.exit(msg)
-    return install_apks(device, del_path[-1], del_path, root)
+    return install_apks(device, aab_apks(device, file), del_path, root)
 
 
+@tracer.wrap
 def install_apk(device: Device, file: Path, del_path: List[Path], root: Path, abc: str = "-rtd") -> Tuple[List[str], bool]:
     """安装apk文件"""
-    name_suffix: str = os.path.split(file)[1]
+    name_suffix: str = cmd_path(file)
     manifest = dump(Path(name_suffix), del_path)
     log.info(manifest)
     checkVersion(device, manifest["package_name"], int(manifest["versionCode"]), manifest["native_code"])
@@ -532,30 +1601,27 @@ def install_apk(device: Device, file: Path, del_path: List[Path], root: Path, ab
     return install, True
 
 
+@tracer.wrap
 def install_apkm(device: Device, file: Path, del_path: List[str], root: str) -> Tuple[List[str], bool]:
-    del_path.append(os.path.join(os.getcwd(), get_unpack_path(file)))
     zip_file = ZipFile(file)
-    upfile = "info.json"
-    zip_file.extract(upfile, del_path[-1])
-    info = read_json(os.path.join(del_path[-1], upfile))
+    info = json_loads(zip_file.read("info.json"))
     file_list = zip_file.namelist()
     log.info(file_list)
     if device.sdk < int(info["min_api"]):
         sys.exit(info_msg["sdktoolow"])
     checkVersion(device, info["pname"], info["versioncode"], info["arches"])
-    install = ["install-multiple", "-rtd"]
-    config, install = build_apkm_config(device, file_list, install)
-    config, install = config_abi(config, install, device.abilist)
-    config, install = config_drawable(config, install)
-    config, install = config_language(config, install)
-    for i in install[5:]:
-        zip_file.extract(i, del_path[-1])
-    os.chdir(del_path[-1])
+    install = ["install-multiple", "-rtd", *get_plan(device, file)["files"]]
+    if device.sdk >= 24:  # shell v2
+        status = install_stream(device, zip_file, install[2:])[1]
+        if status:
+            return install, status
+        log.warning("流式安装失败，将解压后重新安装")
+    install[2:] = extract_splits(device, file, zip_file, install[2:], del_path)
     return install_multiple(device, install)
 
 
+@tracer.wrap
 def install_apks(device: Device, file: Path, del_path: List[Path], root: Path) -> Tuple[List[str], bool]:
-    os.chdir(root)
     zip_file = ZipFile(file)
     file_list = zip_file.namelist()
     if "toc.pb" not in file_list:
@@ -566,19 +1632,21 @@ def install_apks(device: Device, file: Path, del_path: List[Path], root: Path) -
         else:  # unknow
             return [], False
     try:
-        install, status = install_apks_java(file)
+        install, status = install_apks_java(device, file)
         if status:
             return install, status
-    except FileNotFoundError:
+    except OSError:  # 找不到或无法执行 java
         pass
     log.warning("没有配置java环境或存在错误，将尝试直接解析文件")
     return install_apks_py(device, file, del_path)
 
 
-def install_apks_java(file: Path) -> Tuple[List[str], bool]:
-    name_suffix: str = os.path.split(file)[1]
+def install_apks_java(device: Device, file: Path) -> Tuple[List[str], bool]:
+    name_suffix: str = cmd_path(file)
     install = [check_sth("java"), "-jar", check_sth("bundletool"), "install-apks", "--apks="+name_suffix]
-    run, msg = run_msg(install)
+    if device.device:
+        install.append("--device-id="+device.device)
+    run, msg = run_msg(install, on_line=log.debug)
     if run.returncode:
         if "[SCREEN_DENSITY]" in msg:
             sys.exit("Missing APKs for [SCREEN_DENSITY] dimensions in the module 'base' for the provided device.")
@@ -587,37 +1655,42 @@ def install_apks_java(file: Path) -> Tuple[List[str], bool]:
     return install, True
 
 
+@tracer.wrap
 def install_apks_py(device: Device, file: Path, del_path: List[Path]) -> Tuple[List[str], bool]:
     zip_file = ZipFile(file)
     file_list = zip_file.namelist()
-    _path = os.path.join(os.getcwd(), get_unpack_path(file))
-    del_path.append(Path(_path).resolve())
+    _path = Path(get_unpack_path(file, device.device)).resolve()
+    del_path.append(_path)
+    splits = get_plan(device, file)["files"]
+    if len(splits) == 1 and not splits[0].startswith("splits/"):  # standalone
+        return install_apk(device, Path(zip_file.extract(splits[0], _path)), del_path, Path.cwd())
     if device.sdk < 21:
         log.warning("当前安卓版本不支持多apk模式安装，希望apks里有适合的standalone文件")
         for i in file_list:
             f = None
             if f"standalone-{device.abi}_{device.dpi}.apk" in i:
-                f = zip_file.extract(i, del_path[-1])
+                f = zip_file.extract(i, _path)
             else:
                 for a in device.abilist:
                     for d in device.drawable:
                         if f"standalone-{a}_{d}.apk" in i:
-                            f = zip_file.extract(i, del_path[-1])
+                            f = zip_file.extract(i, _path)
             if f:
                 return install_apk(device, Path(f), del_path, Path.cwd())
             log.error("看来没有...")
             sys.exit("没有适合的standalone文件")
-    install = ["install-multiple", ""]
-    for i in file_list:
-        if i.startswith("splits/"):
-            install.append(zip_file.extract(i, del_path[-1]))
-    return install_multiple(device, install)
+    if device.sdk >= 24:  # shell v2
+        status = install_stream(device, zip_file, splits)[1]
+        if status:
+            return ["install-multiple", "", *splits], status
+        log.warning("流式安装失败，将解压后重新安装")
+    return install_multiple(device, ["install-multiple", "", *extract_splits(device, file, zip_file, splits, del_path)])
 
 
 def install_apks_sai(device: Device, file: Path, del_path: List[Path], version: int) -> Tuple[List[str], bool]:
     """用于安装SAI生成的apks文件"""
-    _path = os.path.join(os.getcwd(), get_unpack_path(file))
-    del_path.append(Path(_path).resolve())
+    _path = Path(get_unpack_path(file, device.device)).resolve()
+    del_path.append(_path)
     zip_file = ZipFile(file)
     file_list = zip_file.namelist()
     for i in ["meta.sai_v2.json", "meta.sai_v1.json", "icon.png"]:
@@ -628,8 +1701,8 @@ def install_apks_sai(device: Device, file: Path, del_path: List[Path], version:
     install = [""]
     if version == 2:
         upfile = "meta.sai_v2.json"
-        zip_file.extract(upfile, del_path[-1])
-        data = read_json(os.path.join(del_path[-1], upfile))
+        zip_file.extract(upfile, _path)
+        data = read_json(os.path.join(_path, upfile))
         checkVersion(device, data["package"], data["version_code"])
 
         if data.get("split_apk"):
@@ -651,18 +1724,85 @@ def install_apks_sai(device: Device, file: Path, del_path: List[Path], version:
         return install, False
 
 
+@tracer.wrap
 def install_base(device: Device, file_list: List[str]) -> Tuple[List[dict], bool]:
-    """备用"""
-    SESSION_ID = device._create()
-    info = device._push(file_list)
-    device._write(SESSION_ID, info)
+    """install-multiple 失败时的备用方案：创建安装会话，同时写入所有分包，不经过 /data/local/tmp。
+    没有 shell v2(安卓 7.0 以下)或写入失败时，同时推送到 /data/local/tmp 后写入"""
+    info = [{"name": os.path.splitext(os.path.basename(f))[0], "path": f, "size": os.path.getsize(f)} for f in file_list]
+    SESSION_ID = ""
+    if device.sdk >= 24:
+        SESSION_ID = device._create("-r", "-t", "-d")
+        failed = threading.Event()
+
+        def write(i: dict) -> None:
+            if failed.is_set():  # 已有分包写入失败，不再传输其他分包
+                return
+            with open(i["path"], "rb") as src:
+                if not device._write_stream(SESSION_ID, i["name"], i["size"], src):
+                    failed.set()
+
+        with ThreadPoolExecutor(max_workers=min(4, len(info)), thread_name_prefix=device.device or "write") as pool:
+            list(pool.map(write, info))
+        if failed.is_set():
+            device._abandon(SESSION_ID)
+            SESSION_ID = ""
+    if not SESSION_ID:
+        log.info("无法直接写入安装会话，将推送到 /data/local/tmp 后写入")
+        SESSION_ID = device._create("-r", "-t", "-d")
+        info = device._push(file_list)
+        try:
+            device._write(SESSION_ID, info)
+        finally:
+            device._del(info)
     run = device._commit(SESSION_ID)
-    device._del(info)
     if run.returncode:
         return info, False
     return info, True
 
 
+@tracer.wrap
+def install_device(device: Device, file: Path, del_path: List[Path], root: Path, one: Union[Path, None] = None) -> bool:
+    """在一个设备上安装，多设备安装时每个设备在各自的线程中运行。one 为用户输入的路径"""
+    if not options["converge"]:
+        return install_package(device, file, del_path, root)
+    try:
+        unchanged = check_unchanged(device, file)
+    except Exception:
+        log.exception("Failed in check_unchanged.")
+        unchanged = False
+    status = unchanged or install_package(device, file, del_path, root)
+    print_result(device, one or file, "unchanged" if unchanged else ("installed" if status else "failed"))
+    return status
+
+
+def install_package(device: Device, file: Path, del_path: List[Path], root: Path) -> bool:
+    suffix = os.path.splitext(os.path.split(file)[1])[1]
+    try:
+        if suffix in installSuffix and suffix != ".xapk":
+            return installSelector[suffix](device, file, del_path, root)[1]
+        installer = install_xapk_zip if suffix == ".xapk" else install_xapk
+        status = installer(device, file, del_path, root)[1]
+        if not status:
+            if ask("安装失败！将尝试保留数据卸载重装，可能需要较多时间，是否继续？(y/N)").lower() == "y":
+                package_name: str = read_xapk_manifest(file)["package_name"]
+                if uninstall(device, package_name, root):
+                    if not installer(device, file, del_path, root)[1]:
+                        sys.exit("重新安装失败！")
+            else:
+                sys.exit("用户取消安装！")
+        return True
+    except SystemExit as err:
+        if err.code == 1:
+            log.error("错误    安装失败：未知错误！请提供文件进行适配！")
+        elif err.code != 0:
+            log.error(err)
+        return False
+    except Exception:
+        log.exception("Failed in install_device.")
+        return False
+
+
+@tracer.wrap
 def install_multiple(device: Device, install: List[str]) -> Tuple[List[str], bool]:
     """install-multiple"""
     run = device.adb(install)[0]
@@ -671,112 +1811,116 @@ def install_multiple(device: Device, install: List[str]) -> Tuple[List[str], boo
             install[1] = "-r"
             log.info("正在修改安装参数重新安装，请等待...")
             return install_multiple(device, install)
-        elif install[1] == "r":
+        elif install[1] == "-r":
             install[1] = ""
             log.info("正在修改安装参数重新安装，请等待...")
             return install_multiple(device, install)
         elif install[1] == "":
-            print_err(tostr(run.stderr))
+            print_err(tostr(run.stderr, device.device))
             try:
                 log.info("使用备用方案")
-                _, returncode = install_base(device, install[2:])
-                if not returncode:
+                status = install_base(device, install[2:])[1]
+                if status:
                     return install, True
             except Exception:
                 log.exception("Failed in install_multiple->install_base.")
-    return install, False
+        return install, False
+    return install, True
 
 
+@tracer.wrap
+def install_stream(device: Device, zip_file: ZipFile, file_list: List[str]) -> Tuple[List[str], bool]:
+    """从压缩包中直接写入安装会话，不在电脑上解压。
+    失败时返回 False，由调用者解压后按 install-multiple 的参数顺序重试"""
+    SESSION_ID = device._create("-r", "-t", "-d")
+    for i in file_list:
+        name = os.path.splitext(os.path.basename(i))[0]
+        with zip_file.open(i) as src:
+            if not device._write_stream(SESSION_ID, name, zip_file.getinfo(i).file_size, src):
+                device._abandon(SESSION_ID)
+                return file_list, False
+    return file_list, not device._commit(SESSION_ID).returncode
+
+
+@tracer.wrap
 def install_xapk(device: Device, file: Path, del_path: List[Path], root: Path) -> Union[Tuple[List[Union[str, List[str]]], bool], None]:
     """安装xapk文件"""
     log.info("开始安装...")
-    if not os.path.isfile("manifest.json"):
+    if not os.path.isfile(os.path.join(file, "manifest.json")):
         sys.exit(f"安装失败：路径中没有`manifest.json`。{file!r}不是`xapk`安装包的解压路径！")
-    manifest = read_json("manifest.json")
+    manifest = read_json(os.path.join(file, "manifest.json"))
     if not manifest.get("expansions"):
-        split_apks: List[dict[str, str]] = manifest["split_apks"]
-
-        if device.sdk < int(manifest["min_sdk_version"]):
-            sys.exit(info_msg["sdktoolow"])
-        elif device.sdk > int(manifest["target_sdk_version"]):
-            log.info("警告：安卓版本过高！可能存在兼容性问题！")
-
-        install = ["install-multiple", "-rtd"]
-        config, install = build_xapk_config(device, split_apks, install)
-        if not manifest.get("version_code"):
-            manifest["version_code"] = 0
-        checkVersion(device, manifest["package_name"], int(manifest["version_code"]), abi=config.get("abi"))
-        config, install = config_abi(config, install, device.abilist)
-        config, install = config_drawable(config, install)
-        config, install = config_language(config, install)
+        install = ["install-multiple", "-rtd", *get_plan(device, file)["files"]]
+        check_xapk(device, manifest, install)
+        install[2:] = [os.path.join(file, i) for i in install[2:]]
         return install_multiple(device, install)
     else:
-        install = install_apk(device, manifest["package_name"]+".apk", del_path, root)[0]
-        expansions = manifest["expansions"]
-        for i in expansions:
-            if i["install_location"] == "EXTERNAL_STORAGE":
-                push: List[str] = ["push", i["file"], "/storage/emulated/0/"+i["install_path"]]
-                if device.adb(push)[0].returncode:
-                    return [install, push], False
-                return [install, push], True
-            else:
+        install = install_apk(device, Path(file, manifest["package_name"]+".apk"), del_path, root)[0]
+        push: List[Tuple[str, str]] = []
+        for i in manifest["expansions"]:
+            if i["install_location"] != "EXTERNAL_STORAGE":
                 sys.exit(1)
+            push.append((os.path.join(file, i["file"]), "/storage/emulated/0/"+i["install_path"]))
+        return [install, push], push_expansions(device, push)
+
+
+@tracer.wrap
+def install_xapk_zip(device: Device, file: Path, del_path: List[Path], root: Path) -> Tuple[List[Union[str, List[str]]], bool]:
+    """直接读取xapk压缩包，只解压需要安装的文件"""
+    zip_file = ZipFile(file)
+    manifest = read_xapk_manifest(file)
+    if not manifest.get("expansions"):
+        install = ["install-multiple", "-rtd", *get_plan(device, file)["files"]]
+        check_xapk(device, manifest, install)
+        if device.sdk >= 24:  # shell v2
+            status = install_stream(device, zip_file, install[2:])[1]
+            if status:
+                return install, status
+            log.warning("流式安装失败，将解压后重新安装")
+        install[2:] = extract_splits(device, file, zip_file, install[2:], del_path)
+        return install_multiple(device, install)
+    # 数据包和设备无关，prepare() 已经解压到安装包的临时文件夹，各设备共用
+    _path = Path(get_unpack_path(file)).resolve()
+    if not os.path.isfile(os.path.join(_path, "manifest.json")):
+        unpack(file, unpack_list(file, []))
+    return install_xapk(device, _path, del_path, root)
 
 
 # device: Device, file: str, del_path: List[str], root: str[, abc: str] -> Tuple[List[Union[str, List[str]]], bool]
 installSuffix = [".aab", ".apk", ".apkm", ".apks", ".xapk"]
 installSelector = {".aab": install_aab, ".apk": install_apk, ".apkm": install_apkm, ".apks": install_apks,
-                   ".xapk": install_xapk}
+                   ".xapk": install_xapk_zip}
 
 
-def main(root: Path, one: Path) -> bool:
+@tracer.wrap
+def main(root: Path, one: Path, devices: Union[List[Device], None] = None, item: Union[dict, None] = None) -> bool:
+    """item 为 prepare() 的结果，为空时在这里准备"""
     os.chdir(root)
-    name_suffix = os.path.split(one)[1]
-    name_suffix = name_suffix.rsplit(".", 1)
-    new_path = md5(name_suffix[0])  # md5 用处：避免莫名其妙的文件名导致意料之外的问题
-    if len(name_suffix) > 1:
-        new_path += f".{name_suffix[1]}"
-    _path = os.path.join(root, new_path)
-    del_path = [Path(_path).resolve()]
-    copy = [Path(one).resolve(), del_path[0]]
-    copy_files(copy)
-
     try:
-        ADB: str = check_sth("adb")
-        devices = check(ADB)
-        if len(devices) == 0:
-            sys.exit("安装失败：手机未连接电脑！")
-        suffix = os.path.splitext(os.path.split(copy[1])[1])[1]
-
-        for device in devices:
-            device = Device(device)
-            device.ADB = ADB
-            if str(copy[1]).endswith(".xapk"):
-                del_path.append(unpack(copy[1]))
-            elif suffix in installSuffix:
-                return installSelector[suffix](device, copy[1], del_path, root)[1]
-            elif os.path.isfile(copy[1]):
-                sys.exit(f"{copy[1]!r}不是`{'/'.join(installSuffix)}`安装包！")
-
-            if os.path.isdir(del_path[-1]) and os.path.exists(os.path.join(del_path[-1], "manifest.json")):
-                os.chdir(del_path[-1])
-                install, status = install_xapk(device, del_path[-1], del_path, root)
-                if status:
-                    if input("安装失败！将尝试保留数据卸载重装，可能需要较多时间，是否继续？(y/N)").lower() == "y":
-                        package_name: str = read_json(os.path.join(del_path[-1], "manifest.json"))["package_name"]
-                        if uninstall(device, package_name, root):
-                            if type(install[0][0]) is list:
-                                for i in install:
-                                    run, msg = run_msg(i)
-                                    if run.returncode:
-                                        sys.exit(msg)
-                            else:
-                                run, msg = run_msg(install)
-                                if run.returncode:
-                                    sys.exit(msg)
-                    else:
-                        sys.exit("用户取消安装！")
-        return True
+        if devices is None:
+            devices = get_devices()
+        if item is None:
+            item = prepare(root, one, devices)
+        if item.get("error"):
+            raise item["error"]
+        if item["skip"]:
+            return True
+        file: Path = item["file"]
+        del_path: List[Path] = item["del_path"]
+
+        if len(devices) == 1:
+            return install_device(devices[0], file, del_path, root, item["one"])
+
+        def run(device: Device) -> bool:
+            threading.current_thread().name = device.device
+            return install_device(device, file, del_path, root, item["one"])
+
+        max_workers = int(read_yaml("config.yaml").get("max-workers", 4))
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(devices))) as pool:
+            result = dict(zip([i.device for i in devices], pool.map(run, devices)))
+        for device, status in result.items():
+            log.info(f"{device}：{'安装成功' if status else '安装失败'}")
+        return all(result.values())
     except SystemExit as err:
         if err.code == 1:
             log.error("错误    安装失败：未知错误！请提供文件进行适配！")
@@ -788,8 +1932,26 @@ def main(root: Path, one: Path) -> bool:
         return False
     finally:
         os.chdir(root)
-        for i in del_path:
-            delPath(i)
+        if item:
+            for i in item.get("del_path", []):
+                delPath(i)
+            workspace.release(item)
+            for key in [i for i in list(_plans) if i[0] in [str(item.get("one")), str(item.get("file"))]]:
+                del _plans[key]
+
+
+def manifest_db() -> sqlite3.Connection:
+    global _manifest_ready
+    db = sqlite3.connect(cache_path("manifest.db"), timeout=30)
+    if not _manifest_ready:  # 每个进程只建一次表，之后读取缓存不会写数据库
+        db.execute("CREATE TABLE IF NOT EXISTS manifest (size INTEGER, digest TEXT, data TEXT, PRIMARY KEY (size, digest))")
+        _manifest_ready = True
+    return db
+
+
+def manifest_key(file: Path) -> Tuple[int, str]:
+    """不使用修改时间，每次解压出的相同 apk 也能命中缓存"""
+    return os.path.getsize(file), file_digest(file)
 
 
 def md5(_str: str, encoding="utf-8") -> str:
@@ -799,12 +1961,193 @@ def md5(_str: str, encoding="utf-8") -> str:
     return m.hexdigest()
 
 
+def member_md5(file: Path, name: str) -> str:
+    """安装计划中的文件 name 的 md5，file 为文件夹、apk 或压缩包，压缩包不需要解压"""
+    if os.path.isdir(file):
+        return file_md5(Path(file, name))
+    elif os.path.splitext(file)[1] == ".apk":
+        return file_md5(file)
+    m = _md5()
+    with ZipFile(file) as zip_file, zip_file.open(name) as f:
+        for data in iter(lambda: f.read(1024*1024), b""):
+            m.update(data)
+    return m.hexdigest()
+
+
+def member_size(file: Path, name: str) -> int:
+    """安装计划中的文件 name 的大小，file 为文件夹或压缩包"""
+    if os.path.isdir(file):
+        return os.path.getsize(os.path.join(file, name))
+    with ZipFile(file) as zip_file:
+        return zip_file.getinfo(name).file_size
+
+
 def pause() -> NoReturn:
-    input("按回车键继续...")
+    """--converge 时由脚本调用，不等待"""
+    if not options["converge"]:
+        try:
+            input("按回车键继续...")
+        except EOFError:  # 标准输入已关闭
+            pass
     log.info("正常退出")
     sys.exit(0)
 
 
+def pb_fields(data: bytes) -> List[Tuple[int, Union[int, bytes]]]:
+    """读取一层 protobuf 消息，返回 [(字段编号, 值)]，嵌套的消息为 bytes"""
+    result, i = [], 0
+    while i < len(data):
+        key, i = pb_varint(data, i)
+        field, wire = key >> 3, key & 7
+        if wire == 0:
+            value, i = pb_varint(data, i)
+        elif wire == 2:
+            size, i = pb_varint(data, i)
+            value, i = data[i:i+size], i+size
+        elif wire == 1:
+            value, i = data[i:i+8], i+8
+        elif wire == 5:
+            value, i = data[i:i+4], i+4
+        else:
+            raise ValueError(f"不支持的 wire type：{wire}")
+        result.append((field, value))
+    return result
+
+
+def pb_varint(data: bytes, i: int) -> Tuple[int, int]:
+    result, shift = 0, 0
+    while True:
+        b = data[i]
+        i += 1
+        result |= (b & 0x7F) << shift
+        if b < 0x80:
+            return result, i
+        shift += 7
+
+
+def plan_package(device: Device, file: Path) -> dict:
+    """不安装，只计算会安装哪些文件"""
+    suffix = os.path.splitext(file)[1]
+    item: dict[str, Any] = {"file": str(file), "device": device.device, "package": "", "files": [], "bytes": 0}
+    if os.path.isdir(file) or suffix == ".xapk":
+        manifest = read_xapk_manifest(file)
+        item["package"] = manifest["package_name"]
+        if manifest.get("expansions"):
+            item["files"] = [manifest["package_name"]+".apk", *[i["file"] for i in manifest["expansions"]]]
+            item["action"] = "install + push"
+        else:
+            item["files"] = select_xapk(device, manifest)[2:]
+            item["action"] = "install-session" if suffix == ".xapk" and device.sdk >= 24 else "install-multiple"
+        if os.path.isdir(file):
+            item["bytes"] = sum(os.path.getsize(os.path.join(file, i)) for i in item["files"])
+        else:
+            with ZipFile(file) as zip_file:
+                item["bytes"] = sum(zip_file.getinfo(i).file_size for i in item["files"])
+    elif suffix == ".apkm":
+        with ZipFile(file) as zip_file:
+            item["package"] = json_loads(zip_file.read("info.json"))["pname"]
+            item["files"] = select_apkm(device, zip_file.namelist())[2:]
+            item["bytes"] = sum(zip_file.getinfo(i).file_size for i in item["files"])
+        item["action"] = "install-session" if device.sdk >= 24 else "install-multiple"
+    elif suffix == ".apks":
+        with ZipFile(file) as zip_file:
+            item["files"] = select_apks(device, zip_file)
+            item["bytes"] = sum(zip_file.getinfo(i).file_size for i in item["files"])
+        item["action"] = "install-session" if device.sdk >= 24 else "install-multiple"
+    elif suffix == ".apk":
+        item["package"] = dump(file, [])["package_name"]
+        item["files"] = [os.path.split(file)[1]]
+        item["bytes"] = os.path.getsize(file)
+        item["action"] = "install"
+    elif suffix == ".aab":
+        # 生成的 apks 大小未知，按 aab 的大小估算
+        item["files"] = [os.path.split(file)[1]]
+        item["bytes"] = os.path.getsize(file)
+        item["action"] = "bundletool"
+    else:
+        item["action"] = "skip"
+    return item
+
+
+@tracer.wrap
+def prepare(root: Path, one: Path, devices: Union[List[Device], None] = None) -> dict:
+    """电脑上的准备工作：处理输入文件，检查格式，解析 apk，按安装计划选择每个设备要安装的文件，
+    解压数据包和不能流式安装的分包，设备阶段只需要传输。临时文件放在 workspace 中这个安装包的子文件夹"""
+    workspace.open(root)
+    name_suffix = os.path.split(one)[1]
+    name_suffix = name_suffix.rsplit(".", 1)
+    new_path = md5(name_suffix[0])  # md5 用处：避免莫名其妙的文件名导致意料之外的问题
+    if len(name_suffix) > 1:
+        new_path += f".{name_suffix[1]}"
+    members: List[str] = []
+    if os.path.isfile(one) and os.path.splitext(one)[1] in [".apkm", ".xapk"]:
+        plan = []
+        for device in devices or []:
+            try:
+                plan.append(get_plan(device, one))
+            except Exception:  # 安装这个设备时会再次出错，只影响这个设备
+                log.exception("Failed in prepare->get_plan.")
+        members = unpack_list(one, plan)
+    # 复制输入文件和解压都占用空间，先按最多的占用，链接或直接使用原文件时再释放输入文件的部分
+    input_size = path_size(one)
+    size = input_size + unpack_size(one, members)
+    dir_path, budget = workspace.package(size)
+    item: dict[str, Any] = {"one": one, "file": one, "del_path": [], "skip": False,
+                            "dir": dir_path, "budget": budget, "size": size}
+    try:
+        staged, strategy = stage_input(Path(one).resolve(), Path(dir_path, new_path).resolve())
+        log.info(f"输入文件处理方式：{strategy}")
+        if strategy != "copy":
+            budget.release(input_size)
+            item["size"] -= input_size
+        item["file"] = staged
+        workspace.register(staged, dir_path)
+        for key in list(_plans):  # 安装时使用的是复制、链接后的文件，沿用 build_plan 的结果
+            if key[0] == str(one):
+                _plans[(str(staged), key[1])] = _plans[key]
+        if strategy != "inplace":
+            item["del_path"].append(staged)
+        suffix = os.path.splitext(os.path.split(staged)[1])[1]
+        if os.path.isfile(staged) and suffix not in installSuffix:
+            sys.exit(f"{staged!r}不是`{'/'.join(installSuffix)}`安装包！")
+        elif os.path.isdir(staged) and not os.path.exists(os.path.join(staged, "manifest.json")):
+            item["skip"] = True
+        elif suffix == ".apk":
+            dump(staged, item["del_path"])  # 只在电脑上解析一次，各设备共用结果
+        elif members:  # 只解压一次，不再每个设备各解压一份
+            unpack(staged, members)
+    except BaseException:
+        for i in item["del_path"]:
+            delPath(i)
+        workspace.release(item)
+        raise
+    return item
+
+
+def prepare_ahead(root: Path, files: List[Path], devices: Union[List[Device], None] = None) -> Queue:
+    """在后台线程中依次准备安装包，安装当前安装包时下一个已经准备好。
+    最多提前准备 prepare-ahead 个，临时文件总大小不超过 disk-budget(MB)"""
+    conf = read_yaml("config.yaml")
+    ready: Queue = Queue(maxsize=max(1, int(conf.get("prepare-ahead", 2))))
+
+    def producer() -> None:
+        for one in files:
+            try:
+                item = prepare(root, one, devices)
+            except BaseException as err:  # 包括 sys.exit，交给 main() 处理
+                item = {"one": one, "error": err}
+            ready.put(item)
+
+    threading.Thread(target=producer, name="prepare", daemon=True).start()
+    return ready
+
+
+def path_size(path: Path) -> int:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(i[0], j)) for i in os.walk(path) for j in i[2])
+
+
 def print_err(err: str):
     if "INSTALL_FAILED_VERSION_DOWNGRADE" in err:
         log.warning("警告：降级安装？请确保文件无误！")
@@ -816,37 +2159,200 @@ def print_err(err: str):
         log.error(err)
 
 
+def print_result(device: Device, file: Path, result: str) -> None:
+    """--converge 时每个设备输出一行 json，方便脚本处理"""
+    with _input_lock:
+        print(json_dumps({"file": str(file), "device": device.device, "result": result}, ensure_ascii=False), flush=True)
+
+
+def print_plan(plan: List[dict]) -> None:
+    print("安装计划：")
+    for i in plan:
+        print(f"    {os.path.split(i['file'])[1]} -> {i['device']}：{len(i['files'])}个文件，"
+              f"{size_str(i['bytes'])}（{i['action']}）")
+    print(f"共{len(plan)}项，预计传输 {size_str(sum(i['bytes'] for i in plan))}")
+
+
+@tracer.wrap
 def pull_apk(device: Device, package: str, root: Path) -> Path:
+    """备份安装包和 obb 到 backup/objects，相同内容只保存一份，返回本次备份的清单文件"""
     log.info("正在备份安装包...")
-    run, msg = device.shell(["pm", "path", package])
-    if run.returncode:
-        sys.exit(msg)
-    else:
-        dir_path = Path(os.path.join(root, package)).resolve()
-        if os.path.exists(dir_path):
-            delPath(dir_path)
-        os.mkdir(dir_path)
+    obb_dir = "/storage/emulated/0/Android/obb/"+package
+    # 一次 shell 获取所有文件的大小和 md5。旧设备可能没有 toybox 的 stat、md5sum，这时只有路径
+    cmd = (f"for f in $(pm path {package}) {obb_dir}/*; do f=${{f#package:}}; [ -f \"$f\" ] || continue; "
+           "echo \"__FILE__$f\"; stat -c %s \"$f\" 2>/dev/null; md5sum \"$f\" 2>/dev/null; done")
+    run, msg = device.shell([cmd])
+    files = []
+    for block in tostr(run.stdout, device.device).split("__FILE__")[1:]:
+        lines = [i.strip() for i in block.strip().split("\n")]
+        path, size, _md5sum = lines[0], 0, ""
+        for line in lines[1:]:
+            if line.isdigit():
+                size = int(line)
+            elif re_fullmatch(r"[0-9a-f]{32}\s+.*", line):
+                _md5sum = line.split()[0]
+        files.append({"name": posixpath.basename(path), "path": path, "md5": _md5sum, "size": size,
+                      "type": "obb" if path.startswith(obb_dir+"/") else "apk"})
+    if not [i for i in files if i["type"] == "apk"]:
+        sys.exit(msg or f"没有找到 {package} 的安装包")
+
+    def pull(i: dict) -> None:
+        """设备上没有 md5sum 时先拉取，再在电脑上计算 md5"""
+        if i["md5"] and os.path.isfile(backup_object(root, i["md5"])) and \
+                os.path.getsize(backup_object(root, i["md5"])) == i["size"]:
+            log.info(f"已有备份，跳过：{i['path']}")
+            return
+        tmp = os.path.join(workspace.temp(), f"{md5(i['path'])}.{threading.get_ident()}.tmp")
         try:
-            for i in tostr(run.stdout).strip().split("\n"):
-                run, msg = device.adb(["pull", i[8:].strip(), dir_path])
-                if run.returncode:
-                    sys.exit(msg)
-        except TypeError:
-            log.exception("Failed in pull_apk.")
-            sys.exit(1)
-        cmd = ["pull", "/storage/emulated/0/Android/obb/"+package, dir_path]
-        run, msg = device.adb(cmd)
-        if run.returncode and ("No such file or directory" not in msg) and ("does not exist" not in msg):
-            sys.exit(msg)
-        return dir_path
+            run, msg = device.adb(["pull", i["path"], tmp])
+            if run.returncode:
+                sys.exit(msg)
+            _md5sum = file_md5(tmp)
+            if i["md5"] and _md5sum != i["md5"]:
+                sys.exit(f"备份文件校验失败：{i['path']}")
+            i["md5"], i["size"] = _md5sum, os.path.getsize(tmp)
+            obj = backup_object(root, _md5sum)
+            if not os.path.isfile(obj):
+                os.makedirs(os.path.dirname(obj), exist_ok=True)
+                shutil.move(tmp, obj)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    with ThreadPoolExecutor(max_workers=min(4, len(files)), thread_name_prefix=device.device or "pull") as pool:
+        list(pool.map(pull, {i["md5"] or i["path"]: i for i in files}.values()))  # 相同内容只拉取一次
+    manifest = {"package": package, "device": device.device, "time": int(time.time()), "files": files}
+    dir_path = os.path.join(root, "backup", package)
+    os.makedirs(dir_path, exist_ok=True)
+    manifest_path = Path(dir_path, f"{time.strftime('%Y%m%d-%H%M%S')}-{device.device or 'device'}.json").resolve()
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json_dump(manifest, f, ensure_ascii=False, indent=2)
+    log.info(f"备份清单：{manifest_path}")
+    return manifest_path
+
+
+@tracer.wrap
+def push_expansions(device: Device, expansions: List[Tuple[str, str]]) -> bool:
+    """推送 obb 等数据包 [(电脑上的路径, 设备上的路径)]，多个文件同时推送。
+    设备上已有大小和 md5 都相同的文件时跳过，上次中断留下的文件校验后从断点继续"""
+    if not expansions:
+        return True
+    remote_size = remote_stat(device, [i[1] for i in expansions])
+    # 设备上的文件不比电脑上的大时才可能是同一个文件或中断留下的文件
+    candidate = [i[1] for i in expansions if 0 < remote_size.get(i[1], 0) <= os.path.getsize(i[0])]
+    remote_md5: dict[str, str] = {}
+    if candidate:
+        run = device.shell(["md5sum", *[quote(i) for i in candidate], "2>/dev/null"])[0]
+        for line in tostr(run.stdout, device.device).strip().split("\n"):
+            if "  " in line:
+                _md5sum, path = line.strip().split("  ", 1)
+                remote_md5[path] = _md5sum
+
+    def push(local: str, path: str) -> bool:
+        size = os.path.getsize(local)
+        offset = remote_size.get(path, 0) if path in remote_md5 else 0
+        if offset and file_md5(local, offset) != remote_md5[path]:
+            offset = 0
+        if offset == size:
+            log.info(f"设备上已有相同的文件，跳过：{path}")
+            return True
+        if device.sdk < 24:  # 没有 shell v2，无法通过标准输入传输
+            return not device.adb(["push", local, path])[0].returncode
+        if offset:
+            log.info(f"从 {offset}/{size} 继续推送：{path}")
+        # 用 cat 写入，中断时已写入的部分会保留，下次可以继续
+        cmd = f"mkdir -p {quote(posixpath.dirname(path))} && cat {'>>' if offset else '>'} {quote(path)}"
+        with open(local, "rb") as src:
+            src.seek(offset)
+            run, msg = device.shell_in([cmd], src)
+        if run.returncode:
+            log.error(msg)
+            return False
+        return True
+
+    with ThreadPoolExecutor(max_workers=min(4, len(expansions)), thread_name_prefix=device.device or "push") as pool:
+        status = all(list(pool.map(lambda i: push(*i), expansions)))
+    if status and device.sdk >= 24:
+        remote_size = remote_stat(device, [i[1] for i in expansions])
+        for local, path in expansions:
+            if remote_size.get(path) != os.path.getsize(local):
+                log.error(f"推送不完整：{path}")
+                status = False
+    return status
+
+
+def read_axml(f: BinaryIO) -> dict:
+    """直接读取二进制的 AndroidManifest.xml，只取 manifest 和 uses-sdk 中需要的属性"""
+    # chunk: type(2) + headerSize(2) + size(4)
+    _type, _, _ = struct.unpack("<HHI", f.read(8))
+    if _type != 0x0003:
+        raise ValueError("不是二进制 xml 文件")
+    pool, resource, axml = b"", (), {}
+    while True:
+        head = f.read(8)
+        if len(head) < 8:
+            return axml
+        _type, header_size, size = struct.unpack("<HHI", head)
+        chunk = f.read(size-8)  # 字符串池之外的 chunk 都很小
+        if _type == 0x0001:  # 字符串池
+            pool = head + chunk
+        elif _type == 0x0180:  # 属性名对应的资源 id
+            resource = struct.unpack(f"<{len(chunk)//4}I", chunk)
+        elif _type == 0x0102:  # 开始标签
+            tag = axml_string(pool, struct.unpack_from("<I", chunk, header_size-8+4)[0])
+            if tag not in ["manifest", "uses-sdk"]:
+                continue
+            attr_start, attr_size, attr_count = struct.unpack_from("<HHH", chunk, header_size-8+8)
+            for i in range(attr_count):
+                offset = header_size-8+attr_start+i*attr_size
+                _, name, raw, _, _, data_type, data = struct.unpack_from("<IIIHBBI", chunk, offset)
+                # 混淆过的 apk 属性名可能是空的，优先使用资源 id
+                if name < len(resource) and resource[name] in axml_attr:
+                    key = axml_attr[resource[name]]
+                else:
+                    key = axml_string(pool, name)
+                if data_type == 0x03:  # 字符串
+                    axml[key] = axml_string(pool, data)
+                elif data_type in [0x10, 0x11]:  # 整数
+                    axml[key] = data
+                elif data_type == 0x12:  # 布尔值
+                    axml[key] = data != 0
+                elif raw != 0xFFFFFFFF:
+                    axml[key] = axml_string(pool, raw)
+            if tag == "uses-sdk":
+                return axml
+
+
+def read_xapk_manifest(file: Path) -> dict:
+    """读取xapk的manifest.json，压缩包不需要解压"""
+    if os.path.isdir(file):
+        return read_json(os.path.join(file, "manifest.json"))
+    with ZipFile(file) as zip_file:
+        return json_loads(zip_file.read("manifest.json"))
+
+
+def read_cache(name: str) -> dict:
+    try:
+        return read_json(cache_path(name))
+    except (OSError, ValueError):
+        return {}
 
 
 def read_yaml(file) -> dict:
-    if not os.path.exists(file):
+    """按修改时间缓存，文件未改变时不再重复读取和解码"""
+    try:
+        mtime = os.stat(file).st_mtime_ns
+    except OSError:
         return {}
+    file = os.path.abspath(file)
+    cached = _yaml_cache.get(file)
+    if cached and cached[0] == mtime:
+        return cached[1]
     with open(file, "rb") as f:
         data = f.read()
-    return safe_load(tostr(data))
+    conf = safe_load(tostr(data)) or {}
+    _yaml_cache[file] = (mtime, conf)
+    return conf
 
 
 def read_json(file) -> dict:
@@ -854,51 +2360,395 @@ def read_json(file) -> dict:
         return json_load(f)
 
 
+def parse_split(name: str) -> Tuple[str, str, str]:
+    """分包的 id 或文件名 -> (模块, 维度, 值)，维度为 abi/density/language，不是配置分包时维度为空
+    config.arm64_v8a -> ("base", "abi", "arm64_v8a")
+    split_feature.config.zh.apk -> ("feature", "language", "zh")"""
+    stem = name[:-4] if name.endswith(".apk") else name
+    if stem.startswith("split_"):
+        stem = stem[6:]
+    if not (stem.startswith("config.") or ".config." in stem):
+        return stem, "", ""
+    module, value = stem.rsplit("config.", 1)
+    module = module.rstrip(".") or "base"
+    if value in _abi or value == "riscv64":
+        return module, "abi", value
+    elif value in _density:
+        return module, "density", value
+    elif value in _tcf or value.startswith("tier_"):  # 纹理压缩格式、设备等级，和原来一样直接安装
+        return module, "", value
+    elif re_fullmatch(r"[a-z]{2,3}(_[A-Za-z0-9]+)*", value):
+        return module, "language", value
+    return module, "", value
+
+
+def read_targeting(data: bytes, dimension: dict[int, str]) -> dict[str, Any]:
+    """ApkTargeting/VariantTargeting，dimension 为字段编号和维度的对应关系。
+    只有 alternatives 的分包（如“其他语言”）对应的维度为空列表"""
+    targeting: dict[str, Any] = {}
+    for field, value in pb_fields(data):
+        key = dimension.get(field)
+        if not key:
+            continue
+        # XxxTargeting: value = 1, alternatives = 2，只需要 value
+        values = [v for f, v in pb_fields(value) if f == 1]
+        if key == "sdk":  # SdkVersion: min = 1，min 为 Int32Value: value = 1
+            sdk = [v for i in values for f, m in pb_fields(i) if f == 1 for f2, v in pb_fields(m) if f2 == 1]
+            targeting[key] = min(sdk) if sdk else 1
+            continue
+        targeting[key] = []
+        for i in values:
+            if key == "language":
+                targeting[key].append(i.decode("utf-8"))
+                continue
+            for f, v in pb_fields(i):
+                if key == "abi" and f == 1:  # Abi: alias = 1
+                    targeting[key].append(toc_abi.get(v, ""))
+                elif key == "density" and f in [1, 2]:  # ScreenDensity: density_alias = 1, density_dpi = 2
+                    targeting[key].append(toc_density.get(v, 0) if f == 1 else v)
+    return targeting
+
+
+def read_toc(data: bytes) -> List[dict]:
+    """读取 apks 中的 toc.pb(BuildApksResult)，只取选择分包需要的信息"""
+    variants = []
+    for field, variant in pb_fields(data):
+        if field != 1:  # BuildApksResult.variant
+            continue
+        v: dict[str, Any] = {"targeting": {}, "number": 0, "modules": []}
+        for f, value in pb_fields(variant):
+            if f == 1:
+                v["targeting"] = read_targeting(value, {1: "sdk", 2: "abi", 3: "density"})
+            elif f == 3:
+                v["number"] = value
+            elif f == 2:  # ApkSet
+                module = {"name": "", "install_time": True, "apks": []}
+                for f2, value2 in pb_fields(value):
+                    if f2 == 1:  # ModuleMetadata: name = 1, on_demand_deprecated = 2, delivery_type = 6
+                        for f3, value3 in pb_fields(value2):
+                            if f3 == 1:
+                                module["name"] = value3.decode("utf-8")
+                            elif (f3 == 2 and value3) or (f3 == 6 and value3 not in [0, 1]):
+                                module["install_time"] = False
+                    elif f2 == 2:  # ApkDescription
+                        apk = {"targeting": {}, "path": "", "standalone": False}
+                        for f3, value3 in pb_fields(value2):
+                            if f3 == 1:
+                                apk["targeting"] = read_targeting(value3, {1: "abi", 3: "language", 4: "density", 5: "sdk"})
+                            elif f3 == 2:
+                                apk["path"] = value3.decode("utf-8")
+                            elif f3 == 4:
+                                apk["standalone"] = True
+                        module["apks"].append(apk)
+                v["modules"].append(module)
+        variants.append(v)
+    return variants
+
+
+def reflink(src: Path, dst: Path) -> None:
+    """写时复制，需要文件系统支持（btrfs，xfs 等），Windows 上没有 fcntl，不会调用"""
+    FICLONE = 0x40049409
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+def remote_stat(device: Device, path_list: List[str]) -> dict[str, int]:
+    """一次获取设备上多个文件的大小，不存在的文件不在结果中"""
+    run = device.shell(["stat", "-c", "'%s %n'", *[quote(i) for i in path_list], "2>/dev/null"])[0]
+    result = {}
+    for line in tostr(run.stdout, device.device).strip().split("\n"):
+        if " " in line:
+            size, path = line.strip().split(" ", 1)
+            result[path] = int(size)
+    return result
+
+
+@tracer.wrap
+def resolve_splits(device: Device, names: List[str]) -> List[str]:
+    """从分包中选出需要安装的：非配置分包全部安装，每个模块安装设备支持的最佳 abi，
+    最合适的屏幕密度，以及 Device.locales 中的语言，其他语言不再安装"""
+    install, index = [], {}  # index: (模块, 维度) -> {值: 名称}
+    for name in names:
+        module, dimension, value = parse_split(name)
+        if dimension:
+            index.setdefault((module, dimension), {})[value] = name
+        else:
+            install.append(name)
+    abilist = [i.replace("-", "_") for i in device.abilist]
+    locales = device.locales
+    for (module, dimension), values in index.items():
+        if dimension == "abi":
+            install.extend([values[i] for i in abilist if i in values][:1])
+        elif dimension == "density":
+            density = best_density([_density[i] for i in values], device.dpi)
+            install.extend(values[i] for i in values if _density[i] == density)
+        else:
+            language = [n for v, n in values.items() if v.split("_")[0] in locales]
+            if not language:
+                log.warning(f"{module} 没有 {locales} 的语言包")
+            install.extend(language)
+    log.info(f"需要安装的分包：{install}")
+    return [i for i in names if i in install]  # 保持原来的顺序
+
+
+@tracer.wrap
 def restore(device: Device, dir_path: Path, root: Path):
-    log.info("开始恢复...")
-    os.chdir(dir_path)
+    """dir_path 为备份文件夹，或 pull_apk 返回的备份清单"""
+    if os.path.isfile(dir_path) and str(dir_path).endswith(".json"):
+        manifest = read_json(dir_path)
+        _path = checkout_backup(root, manifest)
+        try:
+            # 按清单中的 type 区分，obb 文件夹中的文件不一定以 .obb 结尾
+            apk = [os.path.join(_path, i["name"]) for i in manifest["files"] if i["type"] == "apk"]
+            expansions = [(os.path.join(_path, i["name"]), i["path"]) for i in manifest["files"] if i["type"] == "obb"]
+            return restore_files(device, apk, expansions, root)
+        finally:
+            delPath(os.path.dirname(_path))
+    package = os.path.split(dir_path)[-1]
     all_file = os.listdir(dir_path)
-    obb = False
-    for i in all_file:
-        if i.endswith(".obb"):
-            obb = True
-            break
-    if obb:
-        for i in all_file:
-            _path = os.path.join(dir_path, i)
-            if i.endswith(".apk"):
-                install_apk(device, Path(_path).resolve(), [], root)
-            elif i.endswith(".obb"):
-                push = ["push", _path,
-                        "/storage/emulated/0/Android/obb/"+os.path.split(dir_path)[-1]]
-                device.adb(push)
-    else:
-        if len(all_file) == 0:
-            sys.exit("备份文件夹为空！")
-        elif len(all_file) == 1:
-            main(root, Path(all_file[0]).resolve())
-        elif len(all_file) > 1:
-            install = ["install-multiple", "-rtd"]
-            install.extend(all_file)
-            install_multiple(device, install)
-    os.chdir(root)
+    obb_dir = "/storage/emulated/0/Android/obb/"+package
+    expansions = [(os.path.join(dir_path, i), f"{obb_dir}/{i}") for i in all_file if i.endswith(".obb")]
+    if package in all_file and os.path.isdir(os.path.join(dir_path, package)):
+        # 旧版本的 pull_apk 会把整个 obb 文件夹拉取到 dir_path/package
+        all_file.remove(package)
+        expansions.extend((os.path.join(dir_path, package, i), f"{obb_dir}/{i}")
+                          for i in os.listdir(os.path.join(dir_path, package)))
+    apk = [os.path.join(dir_path, i) for i in all_file if (i.endswith(".apk") if expansions else not i.endswith(".obb"))]
+    return restore_files(device, apk, expansions, root)
+
+
+def restore_files(device: Device, apk: List[str], expansions: List[Tuple[str, str]], root: Path):
+    """安装备份的 apk，再推送数据包 [(电脑上的路径, 设备上的路径)]"""
+    log.info("开始恢复...")
+    if not apk and not expansions:
+        sys.exit("备份文件夹为空！")
+    elif len(apk) == 1:
+        install_apk(device, Path(apk[0]).resolve(), [], root)
+    elif len(apk) > 1:
+        install_multiple(device, ["install-multiple", "-rtd", *apk])
+    if expansions and not push_expansions(device, expansions):
+        sys.exit("恢复数据包失败！")
+
+
+def run_cmd(cmd: List[str], src: Union[BinaryIO, None] = None, timeout: Union[float, None] = None,
+            on_line: Union[Callable[[str], None], None] = None) -> Tuple[subprocess.CompletedProcess, int]:
+    """执行命令，后台线程同时读取标准输出和错误输出，每读到一行就交给 on_line，src 的内容写入标准输入。
+    超过 timeout 秒(默认见 command_timeout)后结束命令，输出最多保留 output_limit 字节。
+    返回 (CompletedProcess, 写入的字节数)"""
+    if timeout is None:
+        timeout = command_timeout(command_name(cmd))
+    key = encoding_key(cmd)
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE if src else subprocess.DEVNULL,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    buffers = [OutputBuffer(output_limit), OutputBuffer(output_limit)]
+    timed_out = threading.Event()
+
+    def reader(pipe: BinaryIO, buffer: OutputBuffer) -> None:
+        splitter = LineSplitter(on_line, key) if on_line else None
+        with pipe:
+            for data in iter(lambda: pipe.read1(64*1024), b""):
+                buffer.append(data)
+                if splitter:
+                    splitter.feed(data)
+            if splitter:
+                splitter.close()
+
+    def kill() -> None:
+        timed_out.set()
+        proc.kill()
+
+    # 使用当前线程的名称，on_line 中的日志仍然带有设备序列号
+    threads = [threading.Thread(target=reader, args=(pipe, buffer), name=threading.current_thread().name, daemon=True)
+               for pipe, buffer in zip([proc.stdout, proc.stderr], buffers)]
+    for i in threads:
+        i.start()
+    timer = threading.Timer(timeout, kill) if timeout else None
+    if timer:
+        timer.daemon = True
+        timer.start()
+    written = 0
+    try:
+        if src:
+            try:
+                for data in iter(lambda: src.read(1024*1024), b""):
+                    proc.stdin.write(data)
+                    written += len(data)
+            except BrokenPipeError:
+                log.warning("写入中断")
+            finally:
+                try:
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+        returncode = proc.wait()
+        for i in threads:
+            i.join()
+    except BaseException:  # Ctrl+C 或其他线程退出时不留下子进程
+        proc.kill()
+        raise
+    finally:
+        if timer:
+            timer.cancel()
+    stderr = buffers[1].getvalue()
+    if timed_out.is_set():
+        log.error(f"命令超过 {timeout:g} 秒，已结束：{cmd}")
+        stderr += (b"\n" if stderr else b"") + f"命令超时({timeout:g}秒)".encode("utf-8")
+    return subprocess.CompletedProcess(cmd, returncode, buffers[0].getvalue(), stderr), written
 
 
-def run_msg(cmd: Union[str, List[str]]):
+def run_msg(cmd: Union[str, List[str]], timeout: Union[float, None] = None,
+            on_line: Union[Callable[[str], None], None] = None):
     log.info(cmd)
     if type(cmd) is str:
         cmd = shlex_split(cmd)
-    run = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    with tracer.span(command_name(cmd), cmd=cmd) as span:
+        run, _ = run_cmd(cmd, timeout=timeout, on_line=on_line)
+        if tracer.enabled and command_name(cmd) == "adb pull":
+            span["bytes"] = path_size(cmd[-1])
+        elif tracer.enabled and command_name(cmd) in ["adb push", "adb install", "adb install-multiple"]:
+            span["bytes"] = sum(path_size(i) for i in cmd[1:-1 if command_name(cmd) == "adb push" else None]
+                                if os.path.exists(str(i)))
+    key = encoding_key(cmd)
     if run.stderr:
-        return run, tostr(run.stderr)
+        return run, tostr(run.stderr, key)
     if run.stdout:
-        return run, tostr(run.stdout)
+        return run, tostr(run.stdout, key)
     return run, str()
 
 
+def run_pipe(cmd: List[str], src: BinaryIO, timeout: Union[float, None] = None):
+    """同 run_msg，src 的内容会写入标准输入"""
+    log.info(cmd)
+    with tracer.span(command_name(cmd), cmd=cmd) as span:
+        run, span["bytes"] = run_cmd(cmd, src, timeout)
+    key = encoding_key(cmd)
+    if run.stderr:
+        return run, tostr(run.stderr, key)
+    if run.stdout:
+        return run, tostr(run.stdout, key)
+    return run, str()
+
+
+@tracer.wrap
+def select_apks(device: Device, zip_file: ZipFile) -> List[str]:
+    """按 toc.pb 选择和 bundletool install-apks 相同的文件，无法解析时返回所有 splits/*"""
+    file_list = zip_file.namelist()
+    try:
+        variants = read_toc(zip_file.read("toc.pb"))
+    except (KeyError, ValueError, IndexError, UnicodeDecodeError) as err:
+        log.warning(f"无法读取 toc.pb：{err!r}")
+        variants = []
+    abilist: List[str] = device.abilist
+
+    def abi_rank(abi: List[str]) -> int:
+        return min([abilist.index(i) for i in abi if i in abilist] or [len(abilist)])
+
+    variants = [i for i in variants if i["targeting"].get("sdk", 1) <= device.sdk
+                and abi_rank(i["targeting"].get("abi", abilist)) < len(abilist)]
+    if not variants:
+        log.warning("toc.pb 中没有适合的版本，将安装所有分包")
+        return [i for i in file_list if i.startswith("splits/")]
+    density = best_density([j for i in variants for j in i["targeting"].get("density", [])], device.dpi)
+    variant = max(variants, key=lambda i: (i["targeting"].get("sdk", 1), -abi_rank(i["targeting"].get("abi", abilist)),
+                                           density in i["targeting"].get("density", [density]), i["number"]))
+    log.info(f"选择的版本：{variant['number']} {variant['targeting']}")
+    install = []
+    for module in variant["modules"]:
+        if not (module["install_time"] or module["name"] == "base"):
+            continue
+        apks = module["apks"]
+        standalone = [i["path"] for i in apks if i["standalone"]]
+        if standalone:
+            return standalone[:1]
+        rank = min([abi_rank(i["targeting"]["abi"]) for i in apks if i["targeting"].get("abi")] or [len(abilist)])
+        density = best_density([j for i in apks for j in i["targeting"].get("density", [])], device.dpi)
+        for i in apks:
+            targeting = i["targeting"]
+            if "abi" in targeting and not (abi_rank(targeting["abi"]) == rank < len(abilist)):
+                continue
+            if "density" in targeting and density not in targeting["density"]:
+                continue
+            if "language" in targeting and not set(device.locales) & {i.split("-")[0] for i in targeting["language"]}:
+                continue
+            install.append(i["path"])
+    return install
+
+
+def select_apkm(device: Device, file_list: List[str]) -> List[str]:
+    """根据设备信息从apkm中选出需要安装的文件，不会询问用户"""
+    return ["install-multiple", "-rtd", *resolve_splits(device, [i for i in file_list if i.endswith(".apk")])]
+
+
+def select_xapk(device: Device, manifest: dict) -> List[str]:
+    """根据设备信息从split_apks中选出需要安装的文件，不会询问用户"""
+    files = {i["id"]: i["file"] for i in manifest["split_apks"]}
+    return ["install-multiple", "-rtd", *[files[i] for i in resolve_splits(device, list(files))]]
+
+
+def set_manifest_cache(key: Tuple[int, str], manifest: dict) -> None:
+    try:
+        with closing(manifest_db()) as db, db:
+            db.execute("INSERT OR REPLACE INTO manifest VALUES (?, ?, ?)", (*key, json_dumps(manifest)))
+    except sqlite3.Error:
+        log.exception("Failed in set_manifest_cache.")
+
+
+def size_str(size: float) -> str:
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024 or unit == "GB":
+            break
+        size /= 1024
+    return f"{size:.1f} {unit}"
+
+
+@tracer.wrap
+def stage_input(src: Path, dst: Path) -> Tuple[Path, str]:
+    """准备输入文件(夹)，尽量避免复制，返回实际使用的路径和处理方式"""
+    # 路径中只有这些字符时直接使用原文件，否则放到 dst（md5 文件名）
+    if re_fullmatch(r"[\w.:/\\-]+", str(src), ASCII):
+        return src, "inplace"
+    if os.path.lexists(dst):
+        delPath(dst)
+    strategies = ["hardlink", *(["reflink"] if fcntl else []), "symlink"] if os.path.isfile(src) else ["symlink"]
+    for strategy in strategies:
+        try:
+            if strategy == "hardlink":
+                os.link(src, dst)
+            elif strategy == "reflink":
+                reflink(src, dst)
+            else:
+                os.symlink(src, dst, target_is_directory=os.path.isdir(src))
+        except OSError as err:
+            log.info(f"{strategy} 不可用：{err}")
+            if os.path.lexists(dst):
+                delPath(dst)
+            continue
+        log.info(f"使用 {strategy} 将 `{src}` 映射到 `{dst}`")
+        return dst, strategy
+    copy_files([src, dst])
+    return dst, "copy"
+
+
+def trim_aab_cache() -> None:
+    """cache/aab 超过 aab-cache(MB) 时，删除最久没有使用的 apks，本次运行用过的不删除"""
+    limit = int(read_yaml("config.yaml").get("aab-cache", 2048))*1024*1024
+    entries = sorted(os.scandir(cache_path("aab")), key=lambda i: i.stat().st_mtime)
+    total = sum(i.stat().st_size for i in entries)
+    for i in entries:
+        if total <= limit:
+            break
+        with _aab_lock:
+            if os.path.splitext(i.name)[0] in _aab_locks:
+                continue
+        log.info(f"删除缓存的 apks：{i.path}")
+        total -= i.stat().st_size
+        os.remove(i.path)
+
+
+@tracer.wrap
 def uninstall(device: Device, package_name: str, root: Path):
-    dir_path = pull_apk(device, package_name, root)
-    if not dir_path:
+    manifest_path = pull_apk(device, package_name, root)
+    if not manifest_path:
         sys.exit("备份文件时出现错误")
     # adb uninstall package_name
     # 卸载应用时尝试保留应用数据和缓存数据，但是这样处理后只能先安装相同包名的软件再正常卸载才能清除数据！！
@@ -906,23 +2756,68 @@ def uninstall(device: Device, package_name: str, root: Path):
     run = device.shell(["pm", "uninstall", "-k", package_name])[0]
     try:
         if run.returncode:
-            restore(device, dir_path, root)
+            restore(device, manifest_path, root)
     except Exception:
         log.exception("Failed in uninstall->restore.")
-        sys.exit(f"恢复时出现未知错误！请尝试手动操作并反馈该问题！旧版安装包路径：{dir_path}")
+        sys.exit(f"恢复时出现未知错误！请尝试手动操作并反馈该问题！备份清单：{manifest_path}，"
+                 f"清单中的文件按 md5 保存在 {os.path.join(root, 'backup', 'objects')}")
     return run
 
 
-def unpack(file: Path) -> Path:
-    """解压文件"""
+@tracer.wrap
+def unpack(file: Path, members: Union[List[str], None] = None) -> Path:
+    """解压文件到安装包的临时文件夹，各设备共用；members 不为空时只解压其中的文件"""
     unpack_path = get_unpack_path(file)
     log.info("文件越大，解压越慢，请耐心等待...")
-    shutil.unpack_archive(file, unpack_path, "zip")
+    if members is None:
+        shutil.unpack_archive(file, unpack_path, "zip")
+    else:
+        log.info(f"只解压需要的文件：{members}")
+        with ZipFile(file) as zip_file:
+            for i in members:
+                zip_file.extract(i, unpack_path)
     return Path(unpack_path).resolve()
 
 
+def unpack_list(file: Path, plan: List[dict]) -> List[str]:
+    """prepare() 解压的文件，各设备共用：有数据包的 xapk 的 manifest.json、base apk 和所有数据包，
+    以及 plan 中不能流式安装(安卓 7.0 以下)的设备要安装的分包"""
+    if os.path.splitext(file)[1] == ".xapk":
+        manifest = read_xapk_manifest(file)
+        if manifest.get("expansions"):
+            return ["manifest.json", manifest["package_name"]+".apk", *[i["file"] for i in manifest["expansions"]]]
+    return sorted({f for i in plan if i["action"] == "install-multiple" for f in i["files"]})
+
+
+def unpack_size(file: Path, members: List[str]) -> int:
+    """unpack(file, members) 解压后占用的字节数"""
+    if not members:
+        return 0
+    with ZipFile(file) as zip_file:
+        sizes = {i.filename: i.file_size for i in zip_file.infolist()}
+    return sum(sizes.get(i, 0) for i in members)
+
+
+def update_cache(name: str, key: str, value: Any) -> None:
+    """更新缓存文件中的一项，先写临时文件再替换，避免中断时损坏"""
+    with _cache_lock:
+        data = read_cache(name)
+        data[key] = value
+        tmp = cache_path(name)+f".{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json_dump(data, f, ensure_ascii=False)
+        os.replace(tmp, cache_path(name))
+
+
 if __name__ == "__main__":
     argv = sys.argv
+    if "--converge" in argv:
+        argv.remove("--converge")
+        options["converge"] = True
+    for _flag in ["--trace", "--profile"]:
+        if _flag in argv:
+            argv.remove(_flag)
+            options["trace"] = tracer.enabled = True
     if len(argv) < 2 or (len(argv) == 2 and "-l" in argv):
         print("缺少参数！")
         print("xapkInstaller <filepath or dirpath>")
@@ -931,6 +2826,8 @@ if __name__ == "__main__":
         print("    xapkInstaller abc.apk")
         print("    xapkInstaller ./abc/")
         print("    xapkInstaller abc.apkm abc.apks abc.xapk ./abc/")
+        print("    xapkInstaller --converge abc.xapk  # 设备上已安装相同文件时跳过")
+        print("    xapkInstaller --trace abc.xapk  # 记录各阶段耗时，保存到 trace 文件夹")
         pause()
 
     if "-l" in argv:
@@ -951,15 +2848,32 @@ if __name__ == "__main__":
     _len_ = len(argv[1:])
     success = 0
     try:
+        # adb、设备信息只查找一次，所有安装包共用
+        os.chdir(rootdir)
+        workspace.open(rootdir)  # 同时清理之前异常退出留下的临时文件
+        _devices = get_devices()
+        _files = [Path(i).resolve() for i in argv[1:]]
+        _plan = build_plan(_files, _devices)  # 安装、查询已安装的版本都按这个计划进行
+        if not options["converge"]:  # --converge 时只输出 json
+            print_plan(_plan)
+        _ready = prepare_ahead(rootdir, _files, _devices)
         for _i, _one in enumerate(argv[1:]):
             log.info(f"正在安装第{_i+1}/{_len_}个...")
             log.info(str(_one)+" start")
-            if main(rootdir, Path(_one).resolve()):
+            if main(rootdir, Path(_one).resolve(), _devices, _ready.get()):
                 success += 1
                 log.info(str(_one)+" end")
+    except SystemExit as err:
+        log.error(err)
     except Exception:
         log.exception("Failed in unknow err.")
         log.info("error end")
     finally:
         log.info(f"共{_len_}个，成功安装了{success}个。")
+        if options["trace"]:
+            os.makedirs(os.path.join(rootdir, "trace"), exist_ok=True)
+            _trace = os.path.join(rootdir, "trace", time.strftime("%Y%m%d-%H%M%S")+".json")
+            tracer.save(_trace)
+            print(tracer.summary())
+            print(f"trace 已保存到 {_trace}")
         pause()